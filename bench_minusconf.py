@@ -0,0 +1,608 @@
+#!/usr/bin/env python
+"""Benchmarks for minusconf, running on a single host.
+The results are written as JSON, so that they can be compared between releases.
+Apache License 2.0, see the LICENSE file for details."""
+
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+import minusconf
+
+def _legacy_decode_string(buf, pos):
+	""" The byte-by-byte decoder minusconf 1.0 shipped with, for comparison """
+	for i in range(pos, len(buf)):
+		if buf[i:i+1] == minusconf._compat_bytes('\x00'):
+			try:
+				return (buf[pos:i].decode(minusconf._CHARSET), i+1)
+			except UnicodeDecodeError:
+				raise minusconf.MinusconfError('Not a valid ' + minusconf._CHARSET + ' string: ' + repr(buf[pos:i]))
+	
+	raise minusconf.MinusconfError("Premature end of string (Forgot trailing \\0?), buf=" + repr(buf))
+
+def _legacy_decode_advertisement(rawdata):
+	opcode,data = minusconf._parse_packet(rawdata)
+	p = 0
+	res = []
+	for _ in range(5):
+		s,p = _legacy_decode_string(data, p)
+		res.append(s)
+	return res
+
+def _decode_advertisement(rawdata):
+	minusconf._parse_header(rawdata)
+	return minusconf._decode_strings(rawdata, minusconf._HEADER_SIZE, 5)[0]
+
+def _advertisement(aname, stype, sname, location, port):
+	enc = minusconf._encode_string
+	return (minusconf._MAGIC + minusconf._OPCODE_ADVERTISEMENT +
+		enc(aname) + enc(stype) + enc(sname) + enc(location) + enc(port))
+
+def _time_per_call(func, arg, number):
+	def run():
+		try:
+			func(arg)
+		except minusconf.MinusconfError:
+			pass
+	
+	return min(timeit.repeat(run, number=number, repeat=3)) / number
+
+def bench_decoder(number=2000):
+	""" Compares the legacy byte loop with _decode_strings on valid and malformed advertisements """
+	
+	valid = _advertisement('build-server-17.example.com', 'http', 'Continuous integration dashboard', '', '8080')
+	packets = [
+		('valid', valid),
+		('valid-long', _advertisement('a' * 200, 'b' * 200, 'c' * 400, 'd' * 400, 'e' * 200)),
+		('truncated', valid[:-1]),
+		('invalid-utf8', valid[:-6] + minusconf._compat_bytes('\xff\xfe\0') + valid[-3:]),
+		]
+	
+	res = {}
+	for name,packet in packets:
+		legacy = _time_per_call(_legacy_decode_advertisement, packet, number)
+		current = _time_per_call(_decode_advertisement, packet, number)
+		res[name] = {'legacy_us': legacy * 1e6, 'current_us': current * 1e6, 'speedup': legacy / current}
+	
+	return res
+
+def bench_parser(number=20000):
+	""" Packets/s _parse_packet and _decode_strings get through, for realistic queries and advertisements """
+	
+	enc = minusconf._encode_string
+	packets = [
+		('query', minusconf._MAGIC + minusconf._OPCODE_QUERY + enc('') + enc('http') + enc(''), 3),
+		('advertisement', _advertisement('build-server-17.example.com', 'http', 'Continuous integration dashboard', '', '8080'), 5),
+		]
+	
+	res = {}
+	for name,packet,fields in packets:
+		def parse():
+			opcode,data = minusconf._parse_packet(packet)
+			minusconf._decode_strings(data, 0, fields)
+		res[name] = {'packets_per_s': number / min(timeit.repeat(parse, number=number, repeat=3))}
+	
+	return res
+
+class _LegacyServiceAt(object):
+	""" The __dict__-based ServiceAt minusconf 1.0 shipped with, for comparison """
+	
+	def __init__(self, aname, stype, sname, location, port, addr):
+		for k,v in (('aname', aname), ('stype', stype), ('sname', sname), ('location', location), ('port', port), ('addr', addr)):
+			object.__setattr__(self, k, v)
+	
+	def __eq__(self, other):
+		return self.__dict__ == other.__dict__
+	
+	def __hash__(self):
+		return hash(sum((hash(i) for i in self.__dict__.items())))
+
+def bench_service_at(count=20000):
+	""" Memory per ServiceAt object, and the cost of the set membership test Seeker._found_result does """
+	
+	fields = [('advertiser-%d' % (i % 100), 'http', 'instance-%d' % i, '', str(8000 + i % 1000), '10.0.%d.%d' % (i // 256 % 256, i % 256)) for i in range(count)]
+	
+	res = {}
+	for name,cls in (('legacy', _LegacyServiceAt), ('current', minusconf.ServiceAt)):
+		tracemalloc.start()
+		before = tracemalloc.get_traced_memory()[0]
+		objs = [cls(*f) for f in fields]
+		size = (tracemalloc.get_traced_memory()[0] - before) / float(count)
+		tracemalloc.stop()
+		
+		results = set(objs)
+		probe = [cls(*f) for f in fields[:1000]]
+		lookup = min(timeit.repeat(lambda: [o in results for o in probe], number=10, repeat=3)) / (10 * len(probe))
+		res[name] = {'bytes_per_object': size, 'lookup_us': lookup * 1e6}
+	
+	return res
+
+def _free_port():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		sock.bind(('', 0))
+		return sock.getsockname()[1]
+	finally:
+		sock.close()
+
+def _serve_loopback(port, batch_size, services, ready, results):
+	""" Runs an advertiser on port without joining any multicast group.
+	Once no query arrived for a while, puts (queries handled, seconds from the first to the last) into results. """
+	a = minusconf.Advertiser(services, 'bench.loopback')
+	a.port = port
+	a.addresses = []
+	a.batch_size = batch_size
+	a._init_advertiser()
+	a._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+	a._init_batching()
+	ready.set()
+	
+	handled = 0
+	a._sock.settimeout(None)
+	packets = a._recv_packets()
+	start = time.time()
+	a._sock.settimeout(0.5)
+	while True:
+		handled += len(packets)
+		a._handle_packets(packets)
+		end = time.time()
+		try:
+			packets = a._recv_packets()
+		except socket.timeout:
+			break
+	results.put((handled, end - start))
+
+def _run_flood(services, batch_size, query, count):
+	""" Floods an advertiser process on loopback with count queries.
+	Returns a tupel (queries handled, seconds from the first to the last). """
+	
+	port = _free_port()
+	ready = multiprocessing.Event()
+	results = multiprocessing.Queue()
+	p = multiprocessing.Process(target=_serve_loopback, args=(port, batch_size, services, ready, results))
+	p.daemon = True
+	p.start()
+	ready.wait()
+	
+	client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		for _ in range(count):
+			client.sendto(query, ('127.0.0.1', port))
+		return results.get()
+	finally:
+		client.close()
+		p.join()
+
+def bench_batched_io(count=100000, batch_size=64):
+	""" Queries/s an advertiser process answers on loopback with recvfrom and with recvmmsg/sendmmsg.
+	The queries are sent faster than they can be answered, so that the advertiser's receive queue never runs dry. """
+	
+	if minusconf._load_mmsg() == None:
+		return {}
+	
+	query = (minusconf._MAGIC + minusconf._OPCODE_QUERY + minusconf._encode_string('') +
+		minusconf._encode_string('bench') + minusconf._encode_string(''))
+	services = [minusconf.Service('bench', 1000)]
+	
+	res = {}
+	for mode,size in (('recvfrom', None), ('recvmmsg', batch_size)):
+		handled,duration = _run_flood(services, size, query, count)
+		res[mode] = {'sent': count, 'handled': handled, 'queries_per_s': handled / duration}
+	
+	return res
+
+def bench_advertiser_qps(service_counts=(1, 100, 1000, 10000), count=50000):
+	""" Queries/s an advertiser process answers on loopback, depending on the number of services it advertises.
+	'single' queries match one service, 'all' queries every service (only measured for up to 100 services). """
+	
+	enc = minusconf._encode_string
+	res = {}
+	for scount in service_counts:
+		services = [minusconf.Service('bench-' + str(i), 1000 + i, 'instance') for i in range(scount)]
+		queries = [('single', 'bench-0')]
+		if scount <= 100:
+			queries.append(('all', ''))
+		
+		res[str(scount)] = r = {}
+		for name,stype in queries:
+			query = minusconf._MAGIC + minusconf._OPCODE_QUERY + enc('') + enc(stype) + enc('')
+			handled,duration = _run_flood(services, None, query, count // (1 if stype else scount))
+			r[name] = {'queries_per_s': handled / duration, 'replies_per_s': handled * (1 if stype else scount) / duration}
+	
+	return res
+
+class _CollectingSocket(object):
+	def __init__(self):
+		self.sent = []
+	
+	def sendto(self, data, flags, to):
+		self.sent.append(data)
+
+def bench_aggregation(service_counts=(10, 100, 500), number=50):
+	""" Replies to a wildcard query with one advertisement per service and with aggregated advertisements:
+	packets and bytes per query, and the time the advertiser and the seeker spend on them """
+	
+	enc = minusconf._encode_string
+	query = minusconf._MAGIC + minusconf._OPCODE_QUERY + enc('') + enc('') + enc('')
+	accepted = minusconf._encode_extension(minusconf._EXT_ACCEPTED_OPCODES, minusconf._OPCODE_ADVERTISEMENTS)
+	
+	res = {}
+	for scount in service_counts:
+		services = [minusconf.Service('bench-' + str(i), 1000 + i, 'instance', 'host-' + str(i) + '.example.com') for i in range(scount)]
+		a = minusconf.Advertiser(services, 'bench.aggregation')
+		res[str(scount)] = r = {}
+		for mode,qry in (('single', query), ('aggregated', query + accepted)):
+			a._sock = _CollectingSocket()
+			a._handle_packet(qry, ('::1', 1234))
+			replies = list(a._sock.sent)
+			r[mode] = {'packets_per_query': len(replies), 'bytes_per_query': sum(len(data) for data in replies)}
+			r[mode]['advertiser_us_per_query'] = _time_per_call(lambda q: a._handle_packet(q, ('::1', 1234)), qry, number) * 1e6
+			
+			seeker = minusconf.Seeker('')
+			seeker._init_seeker()
+			seeker._sock.close()
+			def receive(replies):
+				seeker.results = set()
+				seeker._digests = {}
+				for data in replies:
+					seeker._handle_packet(data, ('::1', 6376))
+			r[mode]['seeker_us_per_query'] = _time_per_call(receive, replies, number) * 1e6
+	
+	return res
+
+def bench_metrics(number=20000):
+	""" Microseconds an advertiser spends per query and a seeker per reply, without metrics (the default)
+	and with a Metrics object """
+	
+	enc = minusconf._encode_string
+	query = minusconf._MAGIC + minusconf._OPCODE_QUERY + enc('') + enc('bench') + enc('')
+	
+	a = minusconf.Advertiser([minusconf.Service('bench', 1000)], 'bench.metrics')
+	a._sock = _CollectingSocket()
+	a._handle_packet(query, ('::1', 1234))
+	reply = a._sock.sent[0]
+	
+	seeker = minusconf.Seeker('bench')
+	seeker._init_seeker()
+	seeker._sock.close()
+	
+	res = {}
+	for name,metrics in (('disabled', minusconf._NULL_METRICS), ('enabled', minusconf.Metrics())):
+		a.metrics = seeker.metrics = metrics
+		a._sock = _CollectingSocket()
+		res[name] = {
+			'advertiser_us_per_query': _time_per_call(lambda q: a._handle_packet(q, ('::1', 1234)), query, number) * 1e6,
+			'seeker_us_per_reply': _time_per_call(lambda r: seeker._handle_packet(r, ('::1', 6376)), reply, number) * 1e6,
+			}
+	for key in res['disabled']:
+		res['enabled'][key.replace('_us_', '_overhead_us_')] = res['enabled'][key] - res['disabled'][key]
+	
+	return res
+
+def bench_multiprocessing_catalog(service_counts=(1, 10, 100), number=200):
+	""" Time a MultiprocessingAdvertiser's process needs to get its catalog for a query,
+	from a multiprocessing.Manager list proxy (as before) and from shared memory """
+	
+	if getattr(minusconf, 'shared_memory', None) == None:
+		return {}
+	
+	res = {}
+	manager = multiprocessing.Manager()
+	try:
+		for scount in service_counts:
+			services = [minusconf.Service('bench-' + str(i), 1000 + i, 'instance') for i in range(scount)]
+			a = minusconf.Advertiser(services, 'bench.mpcatalog')
+			a.services = manager.list(services)
+			proxy = _time_per_call(lambda a: a._get_catalog().lookup('', ''), a, number)
+			
+			mpa = minusconf.MultiprocessingAdvertiser(services, 'bench.mpcatalog')
+			try:
+				mpa._shared_catalog, writer = minusconf._SharedCatalog(mpa._shared_catalog.name), mpa._shared_catalog
+				shared = _time_per_call(lambda a: a._get_catalog().lookup('', ''), mpa, number * 100)
+				mpa._shared_catalog.close()
+				mpa._shared_catalog = writer
+				update = _time_per_call(lambda a: a.services.append(services[0]), mpa, number)
+			finally:
+				mpa._shared_catalog.close()
+			
+			res[str(scount)] = {'manager_us_per_query': proxy * 1e6, 'shared_memory_us_per_query': shared * 1e6,
+				'shared_memory_us_per_update': update * 1e6}
+	finally:
+		manager.shutdown()
+	
+	return res
+
+def bench_sharded_distribution(workers=(1, 2, 4), clients=64, count=20000):
+	""" How a ShardedAdvertiser distributes unicast and multicast queries from clients sockets among its workers,
+	and how many queries/s they answer together. The queries are sent as fast as possible; some may be dropped. """
+	
+	if not hasattr(minusconf, 'ShardedAdvertiser') or minusconf.shared_memory == None or not hasattr(socket, 'SO_REUSEPORT'):
+		return {}
+	
+	enc = minusconf._encode_string
+	query = minusconf._MAGIC + minusconf._OPCODE_QUERY + enc('') + enc('bench') + enc('')
+	
+	res = {}
+	for wcount in workers:
+		port = _free_port()
+		a = minusconf.ShardedAdvertiser([minusconf.Service('bench', 1000)], 'bench.sharded', workers=wcount)
+		a.port = port
+		a.announce_schedule = ()
+		a.start_blocking()
+		socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(clients)]
+		try:
+			res[str(wcount)] = r = {}
+			for mode,addr in (('unicast', '127.0.0.1'), ('multicast', minusconf._ADDRESS_4)):
+				before = a.queries_per_worker()
+				start = time.time()
+				for i in range(count):
+					socks[i % clients].sendto(query, (addr, port))
+				
+				# Wait until the workers are done
+				handled = None
+				while handled != sum(a.queries_per_worker()):
+					handled = sum(a.queries_per_worker())
+					end = time.time()
+					time.sleep(0.2)
+				
+				per_worker = [n - b for n,b in zip(a.queries_per_worker(), before)]
+				r[mode] = {'sent': count, 'per_worker': per_worker, 'queries_per_s': sum(per_worker) / (end - start)}
+		finally:
+			for sock in socks:
+				sock.close()
+			a.stop_blocking()
+	
+	return res
+
+def _start_advertisers(cls, count, stype, services):
+	res = []
+	for i in range(count):
+		a = cls([], 'bench.advertiser' + str(i))
+		a.start_blocking()
+		a.services += [minusconf.Service(stype, 1000 + j, 'instance' + str(j)) for j in range(services)]
+		res.append(a)
+	return res
+
+def _timed_seek(stype, timeout):
+	""" Returns a tupel (results, seconds to the first result, seconds to the last result) """
+	
+	found = []
+	s = minusconf.Seeker(stype, timeout=timeout, find_callback=lambda seeker, svca: found.append(time.time()))
+	start = time.time()
+	s.run()
+	if not found:
+		return (0, None, None)
+	return (len(s.results), found[0] - start, found[-1] - start)
+
+def _median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def _seek_latency(stype, timeout, repeat):
+	runs = [_timed_seek(stype, timeout) for _ in range(repeat)]
+	return {
+		'results': _median([r[0] for r in runs]),
+		'first_result_ms': _median([r[1] * 1000 for r in runs if r[1] != None] or [-1]),
+		'all_results_ms': _median([r[2] * 1000 for r in runs if r[2] != None] or [-1]),
+		}
+
+def bench_bulk_transfer(service_counts=(500, 2000, 10000), timeout=5.0, repeat=3):
+	""" Milliseconds until a seeker has all services of an advertiser, and how many it got before the timeout,
+	with aggregated advertisements over UDP and with a bulk transfer over TCP """
+	
+	res = {}
+	for count in service_counts:
+		stype = 'bench-bulk-' + str(os.getpid()) + '-' + str(count)
+		a = minusconf.ThreadAdvertiser([minusconf.Service(stype, 1000 + i, 'instance' + str(i), 'host-' + str(i) + '.example.com') for i in range(count)], 'bench.bulk')
+		a.bulk_threshold = 100
+		a.start_blocking()
+		try:
+			res[str(count)] = r = {}
+			for mode,accept_bulk in (('udp', False), ('bulk', True)):
+				runs = []
+				for _ in range(repeat):
+					s = minusconf.Seeker(stype, timeout=timeout, max_results=count)
+					s.accept_bulk = accept_bulk
+					start = time.time()
+					s.run()
+					runs.append(((time.time() - start) * 1000, len(s.results)))
+				r[mode] = {'ms': _median([ms for ms,found in runs]), 'results': _median([found for ms,found in runs])}
+		finally:
+			a.stop_blocking()
+	
+	return res
+
+def bench_seeker_latency(advertisers=2, services=50, timeout=0.5, repeat=5):
+	""" Time from the start of a seek to its first result and to the last one of the full result set,
+	with ThreadAdvertisers on the multicast groups of this host """
+	
+	stype = 'bench-latency-' + str(os.getpid())
+	running = _start_advertisers(minusconf.ThreadAdvertiser, advertisers, stype, services)
+	try:
+		return _seek_latency(stype, timeout, repeat)
+	finally:
+		for a in running:
+			a.stop_blocking()
+
+def bench_seeker_context(number=50):
+	""" Milliseconds per seek (ending with the first result) with a new socket and address resolution each time,
+	and with a shared SeekerContext """
+	
+	stype = 'bench-context-' + str(os.getpid())
+	running = _start_advertisers(minusconf.ThreadAdvertiser, 1, stype, 1)
+	context = minusconf.SeekerContext()
+	try:
+		context.seek(stype, max_results=1) # Warm up
+		return {
+			'new_socket_ms': _time_per_call(lambda _: minusconf.Seeker(stype, max_results=1).run(), None, number) * 1000,
+			'context_ms': _time_per_call(lambda _: context.seek(stype, max_results=1), None, number) * 1000,
+			}
+	finally:
+		context.close()
+		for a in running:
+			a.stop_blocking()
+
+def bench_seeker_pool(query_counts=(10, 50, 200), timeout=1.0):
+	""" Milliseconds until every one of many queries (one per servicetype) has its result, with a Seeker thread
+	per query and with a single SeekerPool, and how many queries got their result before the timeout """
+	
+	res = {}
+	for count in query_counts:
+		stypes = ['bench-pool-' + str(os.getpid()) + '-' + str(i) for i in range(count)]
+		a = minusconf.ThreadAdvertiser([minusconf.Service(stype, 1000) for stype in stypes], 'bench.pool')
+		a.start_blocking()
+		try:
+			start = time.time()
+			seekers = [minusconf.Seeker(stype, timeout=timeout, max_results=1) for stype in stypes]
+			for s in seekers:
+				s.start()
+			for s in seekers:
+				s.join()
+			threads = {'ms': (time.time() - start) * 1000, 'answered': len([s for s in seekers if s.results])}
+			
+			start = time.time()
+			results = minusconf.seek_many(stypes, timeout, max_results=1)
+			pool = {'ms': (time.time() - start) * 1000, 'answered': len([r for r in results if r])}
+			
+			res[str(count)] = {'threads': threads, 'pool': pool}
+		finally:
+			a.stop_blocking()
+	
+	return res
+
+def bench_advertiser_scaling(counts=(1, 2, 4), services=50, timeout=0.5, repeat=3):
+	""" Seek latency with increasing numbers of ThreadAdvertisers (sharing one interpreter)
+	and MultiprocessingAdvertisers (one process each) """
+	
+	classes = [('ThreadAdvertiser', minusconf.ThreadAdvertiser)]
+	if hasattr(minusconf, 'MultiprocessingAdvertiser'):
+		classes.append(('MultiprocessingAdvertiser', minusconf.MultiprocessingAdvertiser))
+	
+	res = {}
+	for name,cls in classes:
+		res[name] = {}
+		for count in counts:
+			stype = 'bench-scaling-' + str(os.getpid()) + '-' + name + str(count)
+			running = _start_advertisers(cls, count, stype, services)
+			try:
+				res[name][str(count)] = _seek_latency(stype, timeout, repeat)
+			finally:
+				for a in running:
+					a.stop_blocking()
+	
+	return res
+
+STARTUP_BUDGET_MS = {'import': 15.0, 'cli_seek': 35.0, 'cli_seek_script': 60.0} # Targets for the time on top of starting the interpreter
+
+def _startup_ms(args, repeat):
+	""" Minimum wall time of running the interpreter with args, in ms """
+	
+	cwd = os.path.dirname(os.path.abspath(minusconf.__file__))
+	devnull = open(os.devnull, 'w')
+	try:
+		times = []
+		for _ in range(repeat):
+			start = time.time()
+			subprocess.check_call([sys.executable] + args, cwd=cwd, stdout=devnull)
+			times.append((time.time() - start) * 1000)
+		return min(times)
+	finally:
+		devnull.close()
+
+def bench_startup(repeat=20):
+	""" Milliseconds for importing minusconf and for a seek from the command line that ends right after the queries
+	are sent, on top of starting the interpreter; compared to STARTUP_BUDGET_MS.
+	Running minusconf.py as a script compiles it every time, python -m minusconf uses the bytecode cache. """
+	
+	interpreter = _startup_ms(['-c', 'pass'], repeat)
+	res = {'interpreter_ms': interpreter}
+	for name,args in (
+			('import', ['-c', 'import minusconf']),
+			('cli_seek', ['-W', 'ignore', '-m', 'minusconf', 'seek', '--timeout', '0']),
+			('cli_seek_script', ['-W', 'ignore', 'minusconf.py', 'seek', '--timeout', '0'])):
+		overhead = _startup_ms(args, repeat) - interpreter
+		res[name] = {'ms': overhead, 'budget_ms': STARTUP_BUDGET_MS[name], 'within_budget': overhead <= STARTUP_BUDGET_MS[name]}
+	
+	return res
+
+SUITES = [
+	('startup', bench_startup),
+	('parser', bench_parser),
+	('decoder', bench_decoder),
+	('service_at', bench_service_at),
+	('advertiser_qps', bench_advertiser_qps),
+	('batched_io', bench_batched_io),
+	('aggregation', bench_aggregation),
+	('metrics', bench_metrics),
+	('multiprocessing_catalog', bench_multiprocessing_catalog),
+	('sharded_distribution', bench_sharded_distribution),
+	('seeker_latency', bench_seeker_latency),
+	('seeker_context', bench_seeker_context),
+	('seeker_pool', bench_seeker_pool),
+	('bulk_transfer', bench_bulk_transfer),
+	('advertiser_scaling', bench_advertiser_scaling),
+	]
+
+def run_suites(names=None, log=None):
+	""" Runs the named suites (default: all) and returns the JSON-serializable report """
+	
+	results = {}
+	for name,func in SUITES:
+		if names and not name in names:
+			continue
+		if log != None:
+			log('Running ' + name + '...')
+		start = time.time()
+		results[name] = func()
+		if log != None:
+			log('  done in %.1f s' % (time.time() - start))
+	
+	return {
+		'minusconf_version': minusconf.VERSION,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+		'results': results,
+		}
+
+def _usage():
+	sys.stderr.write('Usage: ' + sys.argv[0] + ' [-o output.json] [suite...]\n')
+	sys.stderr.write('Suites: ' + ', '.join(name for name,func in SUITES) + '\n')
+	sys.exit(2)
+
+def _main():
+	try:
+		opts,args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output='])
+	except getopt.GetoptError:
+		_usage()
+	
+	output = None
+	for opt,val in opts:
+		if opt in ('-h', '--help'):
+			_usage()
+		elif opt in ('-o', '--output'):
+			output = val
+	for name in args:
+		if not name in dict(SUITES):
+			_usage()
+	
+	report = run_suites(args, lambda msg: sys.stderr.write(msg + '\n'))
+	js = json.dumps(report, indent=2, sort_keys=True)
+	if output == None:
+		print(js)
+	else:
+		f = open(output, 'w')
+		try:
+			f.write(js + '\n')
+		finally:
+			f.close()
+
+if __name__ == '__main__':
+	_main()
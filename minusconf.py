@@ -8,10 +8,18 @@ Most users will want a (Thread)Advertiser to advertise their server's location a
 
 """
 
+import bisect
+import collections
+import errno
+import operator
+import os
+import select
 import struct
 import socket
+import sys
 import threading
 import time
+import zlib
 
 _PORT = 6376
 _ADDRESS_4 = '239.45.99.98'
@@ -36,15 +44,40 @@ try:
 except NameError: # Python 3+
 	_compat_str = str
 
+try:
+	import queue as _compat_queue
+except ImportError: # <3
+	import Queue as _compat_queue
+
 _MAGIC = _compat_bytes('\xad\xc3\xe6\xe7')
 _OPCODE_QUERY = _compat_bytes('\x01')
 _OPCODE_ADVERTISEMENT = _compat_bytes('\x65')
+_OPCODE_ADVERTISEMENTS = _compat_bytes('\x66')
+_OPCODE_ANNOUNCEMENT = _compat_bytes('\x67')
+_OPCODE_GOODBYE = _compat_bytes('\x68')
+_OPCODE_BULK_OFFER = _compat_bytes('\x69')
 _OPCODE_ERROR = _compat_bytes('\x6f')
+_OPCODE_V2 = _compat_bytes('\xfe') # Marks a packet in the v2 encoding; the real opcode follows
 _STRING_TERMINATOR = _compat_bytes('\x00')
+_HEADER_SIZE = len(_MAGIC) + 1 # Magic and opcode; the payload starts here
+_HEADER_SIZE_V2 = _HEADER_SIZE + 1 # Magic, v2 marker and opcode; the field count starts here
+_EXTENSION_HEADER = struct.Struct('!BH') # Type and length of a query extension
+_EXT_KNOWN_ANSWERS = 1
+_EXT_ACCEPTED_OPCODES = 2
+_DIGEST_SIZE = 8 # Bytes of an advertisement digest (truncated SHA-1)
+_FRAME_HEADER = struct.Struct('!H') # Length of a frame in a bulk transfer
 
 _TTL = None
 _MAX_PACKET_SIZE = 2048 # Biggest packet size this implementation will accept"""
+_MAX_AGGREGATE_SIZE = 1400 # Biggest aggregated advertisement to send, to stay below common path MTUs
 _SEEKER_TIMEOUT = 2.0 # Timeout for seeks in s
+_BULK_TIMEOUT = 5.0 # Timeout for every operation of a bulk transfer in s
+_BULK_BUFFER_SIZE = 65536 # Bytes of frames an advertiser collects before sending them in a bulk transfer
+_RETRANSMIT_SCHEDULE = (0.0, 0.05, 0.2, 0.8) # When to send queries, in s after the start of a seek
+_ANNOUNCE_SCHEDULE = (0.0, 1.0, 4.0) # When to announce services, in s after they changed
+_ANNOUNCE_INTERVAL = 0.5 # Minimum time between announcements and between checks for changed services in s
+_POOL_RCVBUF = 1 << 20 # Receive buffer size a SeekerPool asks for, in bytes
+_DISPATCH_INTERVAL = 0.2 # How often the dispatcher of a SeekerContext checks whether it should stop, in s
 
 class MinusconfError(Exception):
 	def __init__(self, msg=''):
@@ -55,7 +88,13 @@ class MinusconfError(Exception):
 		_send_packet(sock, to, _OPCODE_ERROR, _encode_string(self.msg))
 
 class _ImmutableStruct(object):
-	""" Helper structure for immutable objects """
+	""" Helper structure for immutable objects.
+	Subclasses list their fields in __slots__, in the order of their constructor's arguments,
+	and set _key to an attrgetter for them. The hash is computed once, on construction.
+	"""
+	
+	__slots__ = ('_hash',)
+	_key = staticmethod(lambda obj: ())
 	
 	def __setattr__(self, *args):
 		raise TypeError("This structure is immutable")
@@ -63,30 +102,41 @@ class _ImmutableStruct(object):
 	
 	def __init__(self, **kwargs):
 		for k,v in kwargs.items():
-			super(_ImmutableStruct, self).__setattr__(k, v)
+			object.__setattr__(self, k, v)
+		object.__setattr__(self, '_hash', hash(self._key(self)))
+	
+	def __reduce__(self):
+		return (self.__class__, self._key(self))
 	
 	def __eq__(self, other):
-		return self.__dict__ == other.__dict__
+		if self is other:
+			return True
+		if not isinstance(other, _ImmutableStruct):
+			return NotImplemented
+		return self._hash == other._hash and self.__class__ == other.__class__ and self._key(self) == other._key(other)
 	
 	def __ne__(self, other):
-		return self.__dict__ != other.__dict__
+		res = self.__eq__(other)
+		return res if res is NotImplemented else not res
 	
 	def __lt__(self, other):
-		return self.__dict__ < other.__dict__
+		return self._key(self) < other._key(other)
 	
 	def __le__(self, other):
-		return self.__dict__ <= other.__dict__
+		return self._key(self) <= other._key(other)
 	
 	def __gt__(self, other):
-		return self.__dict__ > other.__dict__
+		return self._key(self) > other._key(other)
 	
 	def __ge__(self, other):
-		return self.__dict__ >= other.__dict__
+		return self._key(self) >= other._key(other)
 	
 	def __hash__(self):
-		return hash(sum((hash(i) for i in self.__dict__.items())))
+		return self._hash
 
 class _MinusconfImmutableStruct(_ImmutableStruct):
+	__slots__ = ()
+	
 	def __init__(self, **kwargs):
 		for v in kwargs.values():
 			_check_val(v)
@@ -96,6 +146,9 @@ class _MinusconfImmutableStruct(_ImmutableStruct):
 class Service(_MinusconfImmutableStruct):
 	""" Helper structure for a service."""
 	
+	__slots__ = ('stype', 'port', 'sname', 'location')
+	_key = operator.attrgetter(*__slots__)
+	
 	def __init__(self, stype, port, sname='', location=''):
 		super(Service, self).__init__(stype=stype, port=_compat_str(port), sname=sname, location=location)
 	
@@ -119,6 +172,9 @@ class Service(_MinusconfImmutableStruct):
 class ServiceAt(_MinusconfImmutableStruct):
 	""" A service returned by an advertiser"""
 	
+	__slots__ = ('aname', 'stype', 'sname', 'location', 'port', 'addr')
+	_key = operator.attrgetter(*__slots__)
+	
 	def __init__(self, aname, stype, sname, location, port, addr):
 		super(ServiceAt, self).__init__(
 			aname=aname, stype=stype, sname=sname, location=location, port=port, addr=addr
@@ -148,9 +204,162 @@ class ServiceAt(_MinusconfImmutableStruct):
 			repr(self.port) + ', ' +
 			repr(self.addr) + ')')
 
+class _ServiceList(list):
+	""" A list of services that counts its modifications, so that advertisers know when to rebuild their catalog.
+	If set, on_change is called after every modification. """
+	
+	def __init__(self, *args):
+		super(_ServiceList, self).__init__(*args)
+		self.version = 0
+		self.on_change = None
+	
+	def __reduce__(self):
+		return (_ServiceList, (list(self),))
+
+def _service_list_modifier(name):
+	orig = getattr(list, name)
+	
+	def modifier(self, *args, **kwargs):
+		res = orig(self, *args, **kwargs)
+		self.version += 1
+		if self.on_change != None:
+			self.on_change()
+		return res
+	modifier.__name__ = name
+	
+	return modifier
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__', '__imul__',
+		'append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort', 'clear'):
+	if hasattr(list, _name):
+		setattr(_ServiceList, _name, _service_list_modifier(_name))
+del _name
+
+class _Catalog(object):
+	""" The pre-encoded advertisements of an advertiser, indexed by (servicetype, servicename).
+	Every entry is also filed under the wildcard keys, so that any query is a single dict lookup.
+	Aggregated advertisements are built on first use and cached per key.
+	The v2 encoding of an entry is built when it is first asked for in that encoding.
+	"""
+	
+	def __init__(self, aname, services, version=None):
+		self.aname = aname
+		self.services = services
+		self.version = version
+		
+		self._encoded_aname = encoded_aname = _encode_string(aname)
+		self._encoded_aname_v2 = _encode_field(aname)
+		self._index = {}
+		self._aggregated = {}
+		self._v2 = {} # digest -> (v2 advertisement packet, v2 record)
+		for svc in list(services):
+			record = (_encode_string(svc.stype) +
+				_encode_string(svc.sname) +
+				_encode_string(svc.location) +
+				_encode_string(svc.port)
+				)
+			packet = _MAGIC + _OPCODE_ADVERTISEMENT + encoded_aname + record
+			
+			entry = (svc, packet, _digest(encoded_aname + record), record)
+			for key in set([(svc.stype, svc.sname), (svc.stype, ''), ('', svc.sname), ('', '')]):
+				self._index.setdefault(key, []).append(entry)
+	
+	def lookup(self, stype, sname):
+		""" Returns a list of (service, advertisement packet, digest, record) tupels matching the query """
+		return self._index.get((stype, sname), ())
+	
+	def replies(self, stype, sname, known=frozenset(), aggregate=False, v2=False):
+		""" Returns the list of packets answering a query, skipping the services whose digests are in known.
+		If aggregate is set, the services are packed into as few aggregated advertisements as possible.
+		If v2 is set, the packets are in the v2 encoding. """
+		
+		entries = self.lookup(stype, sname)
+		if known:
+			entries = [e for e in entries if not (e[2] in known)]
+		elif aggregate:
+			res = self._aggregated.get((stype, sname, v2))
+			if res == None:
+				res = self._aggregated[(stype, sname, v2)] = self._aggregate(entries, v2=v2)
+			return res
+		
+		if aggregate:
+			return self._aggregate(entries, v2=v2)
+		if v2:
+			return [self._encode_v2(e)[0] for e in entries]
+		return [e[1] for e in entries]
+	
+	def count(self, stype, sname, known=frozenset()):
+		""" Returns the number of services matching a query, without those whose digests are in known """
+		
+		entries = self.lookup(stype, sname)
+		if known:
+			return len([e for e in entries if not (e[2] in known)])
+		return len(entries)
+	
+	def digests(self):
+		return frozenset(entry[2] for entry in self.lookup('', ''))
+	
+	def _aggregate(self, entries, opcode=_OPCODE_ADVERTISEMENTS, v2=False):
+		if v2:
+			head = _MAGIC + _OPCODE_V2 + opcode
+			overhead = len(head) + 2 + len(self._encoded_aname_v2) # The field count takes 2 bytes at most in a packet this small
+			encoded = [self._encode_v2(entry)[1] for entry in entries]
+		else:
+			head = _MAGIC + opcode + self._encoded_aname
+			overhead = len(head)
+			encoded = [entry[3] for entry in entries]
+		
+		res = []
+		records = []
+		size = overhead
+		for record in encoded:
+			if records and size + len(record) > _MAX_AGGREGATE_SIZE:
+				res.append(self._pack(head, records, v2))
+				records = []
+				size = overhead
+			records.append(record)
+			size += len(record)
+		
+		if records:
+			res.append(self._pack(head, records, v2))
+		return res
+	
+	def _pack(self, head, records, v2):
+		if v2:
+			return head + _encode_varint(1 + 4 * len(records)) + self._encoded_aname_v2 + _compat_bytes('').join(records)
+		return head + _compat_bytes('').join(records)
+	
+	def _encode_v2(self, entry):
+		""" Returns a tupel (advertisement packet, record) of an entry in the v2 encoding """
+		
+		res = self._v2.get(entry[2])
+		if res == None:
+			svc = entry[0]
+			record = _encode_field(svc.stype) + _encode_field(svc.sname) + _encode_field(svc.location) + _encode_field(svc.port)
+			packet = _MAGIC + _OPCODE_V2 + _OPCODE_ADVERTISEMENT + _encode_varint(5) + self._encoded_aname_v2 + record
+			res = self._v2[entry[2]] = (packet, record)
+		return res
+
 class Advertiser(object):
 	""" Generic implementation of a -conf advertiser. You will probably want to use one of the subclasses.
 	If ignore_unavailable is set, unsupported addresses (typically IPv6) are silently ignored
+	
+	Replies are served from a cached catalog of pre-encoded advertisements. The catalog is rebuilt
+	when aname or services are set, or when services (a list) is modified in place.
+	
+	Set batch_size before starting to receive and answer up to that many packets per system call.
+	This uses recvmmsg/sendmmsg and is silently ignored where these are not available.
+	
+	Set query_filter to a QueryFilter to drop floods and duplicate queries before they are processed.
+	
+	Set metrics to a Metrics object to count packets, queries and replies, and to measure the time spent per packet.
+	
+	Set bulk_threshold to a number of services before starting to serve catalogs over TCP: seekers that accept it
+	get the TCP port instead of advertisements when more services match their query, and fetch them all from there.
+	
+	While running, the services are announced to the multicast groups, at the times in announce_schedule
+	(in seconds after the start or a change of the services; empty to disable) but at most every announce_interval seconds.
+	Changes are noticed within announce_interval seconds. Services that go away, also when the advertiser is stopped, get a goodbye.
 	"""
 	
 	def __init__(self, services=[], aname=None, ignore_unavailable=True):
@@ -161,18 +370,58 @@ class Advertiser(object):
 		self.port = _PORT
 		self.addresses = _ADDRESSES
 		self.ignore_unavailable = ignore_unavailable
+		self.batch_size = None
+		self.query_filter = None
+		self.metrics = _NULL_METRICS
+		self.announce_schedule = _ANNOUNCE_SCHEDULE
+		self.announce_interval = _ANNOUNCE_INTERVAL
+		self._announcer_should_stop = None
+		self._announcer = None
+		self.bulk_threshold = None
+		self._bulk_sock = None
 	
 	def _set_aname(self, aname):
 		_check_val(aname)
 		self._aname = aname
+		self._catalog = None
 	aname = property(fget=lambda self:self._aname, fset=_set_aname)
 	
+	def _set_services(self, services):
+		# Plain lists are copied so that in-place modifications can be tracked.
+		# Other sequences (for example proxies) are used as-is, but can't be cached.
+		if isinstance(services, list) and not isinstance(services, _ServiceList):
+			services = _ServiceList(services)
+		self._services = services
+		self._catalog = None
+	services = property(fget=lambda self:self._services, fset=_set_services)
+	
 	def run(self):
 		self._init_advertiser()
+		self._init_batching()
+		self._start_bulk_server()
+		self._start_announcer()
 		
 		while True:
-			rawdata,sender = self._sock.recvfrom(_MAX_PACKET_SIZE)
+			self._handle_packets(self._recv_packets())
+	
+	def _init_batching(self):
+		if self.batch_size:
+			self._sock = _BatchedSocket.create(self._sock, self.batch_size) or self._sock
+	
+	def _recv_packets(self):
+		""" Blocks until at least one packet arrives. Returns a list of (rawdata, sender) tupels. """
+		
+		if isinstance(self._sock, _BatchedSocket):
+			return self._sock.recv_batch()
+		
+		return [self._sock.recvfrom(_MAX_PACKET_SIZE)]
+	
+	def _handle_packets(self, packets):
+		for rawdata,sender in packets:
 			self._handle_packet(rawdata, sender)
+		
+		if isinstance(self._sock, _BatchedSocket):
+			self._sock.flush()
 	
 	def _init_advertiser(self):
 		sock = _find_sock()
@@ -184,23 +433,51 @@ class Advertiser(object):
 		
 		addrs = _resolve_addrs(self.addresses, None, self.ignore_unavailable, (sock.family,))
 		
+		self._groups = []
 		for fam,to,orig_fam,orig_addr in addrs:
 			try:
 				_multicast_join_group(sock, orig_fam, orig_addr)
+				self._groups.append((orig_fam, orig_addr))
 			except socket.error:
 				if not self.ignore_unavailable:
 					raise
 		
 		self._sock = sock
 	
+	def _close_advertiser(self):
+		""" Leaves the multicast groups and closes the sockets """
+		
+		self._stop_bulk_server()
+		for family,addr in self._groups:
+			try:
+				_multicast_leave_group(self._sock, family, addr)
+			except socket.error:
+				pass
+		self._groups = []
+		self._sock.close()
+	
 	def _handle_packet(self, rawdata, sender):
+		metrics = self.metrics
+		metrics.count('packets_received')
+		if not metrics.enabled:
+			self._process_packet(rawdata, sender)
+			return
+		
+		start = time.time()
+		self._process_packet(rawdata, sender)
+		metrics.observe('packet_seconds', time.time() - start)
+	
+	def _process_packet(self, rawdata, sender):
+		if self.query_filter != None and not self.query_filter.allow(rawdata, sender):
+			self.metrics.count('packets_filtered')
+			return
+		
+		opcode = _packet_opcode(rawdata)
 		try:
-			opcode, data = _parse_packet(rawdata)
-			
 			if opcode == _OPCODE_QUERY:
-				self._handle_query(sender, data)
-			elif opcode == _OPCODE_ERROR:
-				pass # Explicitely prevent bouncing errors
+				self._handle_query(sender, rawdata)
+			elif opcode != None and 100 <= struct.unpack('!B', opcode)[0] <= 199:
+				pass # Other advertisers' packets, for example announcements. Explicitely prevents bouncing errors
 			elif opcode == None:
 				raise MinusconfError('Minusconf magic missing. See http://code.google.com/p/minusconf/source/browse/trunk/protocol.txt for details.')
 			else:
@@ -209,27 +486,409 @@ class Advertiser(object):
 		#except MinusconfError, mce:
 			#mce.send(self._sock, sender)
 		except MinusconfError:
+			self.metrics.count('packets_rejected' if opcode == None else 'packets_malformed')
+	
+	def _start_bulk_server(self):
+		""" Starts a thread that accepts bulk transfers, if bulk_threshold is set """
+		
+		if self.bulk_threshold == None:
+			return
+		
+		sock = socket.socket(self._sock.family, socket.SOCK_STREAM)
+		sock.bind(('', 0))
+		sock.listen(16)
+		self._bulk_sock = sock
+		
+		def server():
+			while True:
+				try:
+					conn,addr = sock.accept()
+				except socket.error: # Stopped
+					return
+				t = threading.Thread(target=self._serve_bulk, args=(conn,))
+				t.daemon = True
+				t.start()
+		
+		t = threading.Thread(target=server)
+		t.daemon = True
+		t.start()
+	
+	def _stop_bulk_server(self):
+		sock = self._bulk_sock
+		if sock != None:
+			self._bulk_sock = None
+			try:
+				sock.shutdown(socket.SHUT_RDWR) # Wakes up accept()
+			except socket.error:
+				pass
+			sock.close()
+	
+	def _serve_bulk(self, conn):
+		""" Answers the query of a bulk transfer with frames of aggregated advertisements, ending with an empty frame """
+		
+		try:
+			conn.settimeout(_BULK_TIMEOUT)
+			rawdata = _recv_frame(conn)
+			if rawdata == None or _packet_opcode(rawdata) != _OPCODE_QUERY:
+				return
+			(qaname, qstype, qsname),p = _decode_payload(rawdata, 3)
+			
+			catalog = self._get_catalog()
+			buf = []
+			size = 0
+			if _string_match(qaname, catalog.aname):
+				known = _split_digests(_decode_extensions(rawdata, p).get(_EXT_KNOWN_ANSWERS))
+				for packet in catalog.replies(qstype, qsname, known, True, _is_v2(rawdata)):
+					buf.append(_FRAME_HEADER.pack(len(packet)) + packet)
+					size += _FRAME_HEADER.size + len(packet)
+					if size >= _BULK_BUFFER_SIZE:
+						conn.sendall(_compat_bytes('').join(buf))
+						buf = []
+						size = 0
+			buf.append(_FRAME_HEADER.pack(0))
+			conn.sendall(_compat_bytes('').join(buf))
+			self.metrics.count('bulk_transfers')
+		except (socket.error, MinusconfError):
 			pass
+		finally:
+			conn.close()
+	
+	def _init_announcements(self):
+		self._announced = None # The catalog last announced
+		self._announce_at = []
+		self._last_announcement = None
+	
+	def _start_announcer(self):
+		""" Starts a thread that sends the announcements """
+		
+		self._init_announcements()
+		if not self.announce_schedule:
+			return
+		
+		should_stop = self._announcer_should_stop = threading.Event()
+		def announcer():
+			while not should_stop.is_set():
+				delay = self._announce()
+				should_stop.wait(delay)
+		
+		t = self._announcer = threading.Thread(target=announcer)
+		t.daemon = True
+		t.start()
+	
+	def _stop_announcer(self):
+		""" Stops the announcements and says goodbye """
+		
+		if self._announcer_should_stop != None:
+			self._announcer_should_stop.set()
+			self._announcer_should_stop = None
+			if self._announcer != None: # So that no announcement follows the goodbye
+				self._announcer.join()
+				self._announcer = None
+			self._goodbye()
+	
+	def _announce(self):
+		""" Sends goodbyes for services that went away, and the announcements that are due.
+		Returns the number of seconds until this should be called again. """
+		
+		now = time.time()
+		catalog = self._get_catalog()
+		if catalog is not self._announced:
+			digests = catalog.digests()
+			old = self._announced
+			if old == None or digests != old.digests():
+				if old != None:
+					self._send_unsolicited(_OPCODE_GOODBYE, old, [e for e in old.lookup('', '') if not (e[2] in digests)])
+				self._announce_at = [now + t for t in self.announce_schedule]
+			self._announced = catalog
+		
+		interval = self.announce_interval
+		earliest = now if self._last_announcement == None else self._last_announcement + interval
+		if self._announce_at and self._announce_at[0] <= now and earliest <= now:
+			while self._announce_at and self._announce_at[0] <= now:
+				self._announce_at.pop(0)
+			self._send_unsolicited(_OPCODE_ANNOUNCEMENT, catalog, catalog.lookup('', ''))
+			self._last_announcement = now
+			earliest = now + interval
+		
+		if self._announce_at:
+			return max(0, min(interval, max(self._announce_at[0], earliest) - now))
+		return interval
+	
+	def _goodbye(self, sock=None):
+		""" Sends a goodbye for all services, through sock (default: the advertiser's socket) """
+		
+		catalog = self._get_catalog()
+		self._send_unsolicited(_OPCODE_GOODBYE, catalog, catalog.lookup('', ''), sock)
+	
+	def _send_unsolicited(self, opcode, catalog, entries, sock=None):
+		""" Sends the services in entries to the multicast groups """
+		
+		if sock == None:
+			sock = self._sock
+		if not entries:
+			return
+		
+		addrs = _resolve_addrs(self.addresses, self.port, True, [sock.family])
+		for packet in catalog._aggregate(entries, opcode):
+			for fam,to,orig_fam,orig_addr in addrs:
+				try:
+					sock.sendto(packet, 0, to)
+					self.metrics.count('goodbyes_sent' if opcode == _OPCODE_GOODBYE else 'announcements_sent')
+				except socket.error:
+					self.metrics.count('send_errors')
+					if not self.ignore_unavailable:
+						raise
 	
 	def services_matching(self, stype, sname):
-		return filter(lambda svc: svc.matches_query(stype, sname), self.services)
-	
-	def _handle_query(self, sender, qrydata):
-		qaname,p = _decode_string(qrydata, 0)
-		qstype,p = _decode_string(qrydata, p)
-		qsname,p = _decode_string(qrydata, p)
-		
-		if _string_match(qaname, self.aname):
-			for svc in self.services_matching(qstype, qsname):
-				rply = (
-					_encode_string(self.aname) +
-					_encode_string(svc.stype) +
-					_encode_string(svc.sname) +
-					_encode_string(svc.location) +
-					_encode_string(svc.port)
-					)
-				
-				_send_packet(self._sock, sender, _OPCODE_ADVERTISEMENT, rply)
+		return [entry[0] for entry in self._get_catalog().lookup(stype, sname)]
+	
+	def _get_catalog(self):
+		""" Returns the catalog for the current services and aname, rebuilding it if necessary """
+		
+		services = self.services
+		version = getattr(services, 'version', None) # Read before building, in case of concurrent modifications
+		catalog = self._catalog
+		if catalog is None or version is None or catalog.services is not services or catalog.version != version:
+			catalog = _Catalog(self.aname, services, version)
+			if version is not None:
+				self._catalog = catalog
+		
+		return catalog
+	
+	def _handle_query(self, sender, rawdata):
+		""" Answers a query, in the encoding of the query """
+		
+		(qaname, qstype, qsname),p = _decode_payload(rawdata, 3)
+		v2 = _is_v2(rawdata)
+		
+		metrics = self.metrics
+		metrics.count('queries_received')
+		catalog = self._get_catalog()
+		if _string_match(qaname, catalog.aname):
+			extensions = _decode_extensions(rawdata, p)
+			known = _split_digests(extensions.get(_EXT_KNOWN_ANSWERS))
+			accepted = extensions.get(_EXT_ACCEPTED_OPCODES, _compat_bytes(''))
+			aggregate = _OPCODE_ADVERTISEMENTS in accepted
+			
+			bulk_sock = self._bulk_sock
+			if bulk_sock != None and _OPCODE_BULK_OFFER in accepted and len(catalog.lookup(qstype, qsname)) > self.bulk_threshold:
+				count = catalog.count(qstype, qsname, known)
+				if count > self.bulk_threshold:
+					offer = [catalog.aname, str(count), str(bulk_sock.getsockname()[1])]
+					_send_fields(self._sock, sender, _OPCODE_BULK_OFFER, offer, v2)
+					metrics.count('bulk_offers_sent')
+					return
+			
+			replies = catalog.replies(qstype, qsname, known, aggregate, v2)
+			for packet in replies:
+				self._sock.sendto(packet, 0, sender)
+			if replies:
+				metrics.count('queries_answered')
+				metrics.count('replies_sent', len(replies))
+
+class QueryFilter(object):
+	""" Decides which incoming packets an advertiser processes at all.
+	Every sending host gets a token bucket: it may send rate packets per second, in bursts of up to burst packets.
+	Identical packets from the same host within dedupe_window seconds are only processed once.
+	IPv4-mapped IPv6 addresses count as the corresponding IPv4 address, so that a query arriving on
+	both address families is recognized as a duplicate. Set rate or dedupe_window to None to disable that check.
+	Each table holds at most max_entries entries; the oldest ones are evicted first.
+	"""
+	
+	def __init__(self, rate=20.0, burst=40, dedupe_window=0.02, max_entries=4096):
+		self.rate = rate
+		self.burst = burst
+		self.dedupe_window = dedupe_window
+		self.max_entries = max_entries
+		
+		self._buckets = collections.OrderedDict() # host -> (tokens, time of last update)
+		self._recent = collections.OrderedDict() # (host, packet) -> arrival time, oldest first
+		self.dropped = 0
+	
+	def allow(self, rawdata, sender, now=None):
+		""" Returns whether the packet rawdata from sender should be processed """
+		
+		if now == None:
+			now = time.time()
+		host = sender[0]
+		if host.startswith('::ffff:'):
+			host = host[len('::ffff:'):]
+		
+		if self.dedupe_window != None:
+			recent = self._recent
+			while recent:
+				key,arrival = next(iter(recent.items()))
+				if now - arrival < self.dedupe_window and len(recent) < self.max_entries:
+					break
+				del recent[key]
+			
+			key = (host, rawdata)
+			if key in recent:
+				self.dropped += 1
+				return False
+			recent[key] = now
+		
+		if self.rate != None:
+			buckets = self._buckets
+			tokens,last = buckets.pop(host, (self.burst, now))
+			tokens = min(self.burst, tokens + (now - last) * self.rate)
+			if tokens < 1:
+				buckets[host] = (tokens, now)
+				self.dropped += 1
+				return False
+			buckets[host] = (tokens - 1, now)
+			if len(buckets) > self.max_entries:
+				buckets.popitem(last=False)
+		
+		return True
+
+class Metrics(object):
+	""" Counts what advertisers and seekers do; set their metrics attribute to one of these.
+	Counters are increased with count(name, n) and durations (in seconds) are recorded with observe(name, seconds),
+	in histograms with the upper bucket bounds buckets. One Metrics object can be shared by several advertisers
+	and seekers; labels (a dict) are added to every exported value to tell them apart.
+	
+	snapshot() returns the current values, prometheus_text() formats them in the Prometheus text format and
+	write_prometheus() writes that to a file or socket. start_exporting() calls an exporter with this object
+	every interval seconds, in a thread of its own.
+	The metrics of a MultiprocessingAdvertiser are recorded in the advertiser process.
+	"""
+	
+	enabled = True
+	BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3)
+	
+	def __init__(self, labels=None, prefix='minusconf_', buckets=BUCKETS):
+		self.labels = labels if labels != None else {}
+		self.prefix = prefix
+		self.buckets = tuple(buckets)
+		
+		self._lock = threading.Lock()
+		self._counters = {} # name -> value
+		self._histograms = {} # name -> [count per bucket (the last one without upper bound), sum, count]
+		self._exporter_should_stop = None
+	
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_lock']
+		state['_exporter_should_stop'] = None
+		return state
+	
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+	
+	def count(self, name, n=1):
+		self._lock.acquire()
+		try:
+			self._counters[name] = self._counters.get(name, 0) + n
+		finally:
+			self._lock.release()
+	
+	def observe(self, name, seconds):
+		self._lock.acquire()
+		try:
+			histogram = self._histograms.get(name)
+			if histogram == None:
+				histogram = self._histograms[name] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+			histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+			histogram[1] += seconds
+			histogram[2] += 1
+		finally:
+			self._lock.release()
+	
+	def snapshot(self):
+		""" Returns a dict with the counters as 'counters' (name -> value) and the histograms as 'histograms'
+		(name -> dict with 'buckets', a list of (upper bound, cumulative count), 'sum' and 'count') """
+		
+		self._lock.acquire()
+		try:
+			counters = dict(self._counters)
+			histograms = {}
+			for name,(counts,total,count) in self._histograms.items():
+				cumulative = 0
+				buckets = []
+				for bound,n in zip(self.buckets + (float('inf'),), counts):
+					cumulative += n
+					buckets.append((bound, cumulative))
+				histograms[name] = {'buckets': buckets, 'sum': total, 'count': count}
+		finally:
+			self._lock.release()
+		
+		return {'counters': counters, 'histograms': histograms}
+	
+	def prometheus_text(self):
+		""" Returns the metrics in the Prometheus text exposition format """
+		
+		def fmt(name, labels, value):
+			labels = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k,v in sorted(labels.items()))
+			return self.prefix + name + ('{' + labels + '}' if labels else '') + ' ' + repr(value) + '\n'
+		
+		snapshot = self.snapshot()
+		res = []
+		for name,value in sorted(snapshot['counters'].items()):
+			res.append('# TYPE ' + self.prefix + name + '_total counter\n')
+			res.append(fmt(name + '_total', self.labels, value))
+		for name,histogram in sorted(snapshot['histograms'].items()):
+			res.append('# TYPE ' + self.prefix + name + ' histogram\n')
+			for bound,count in histogram['buckets']:
+				labels = dict(self.labels)
+				labels['le'] = '+Inf' if bound == float('inf') else repr(bound)
+				res.append(fmt(name + '_bucket', labels, count))
+			res.append(fmt(name + '_sum', self.labels, histogram['sum']))
+			res.append(fmt(name + '_count', self.labels, histogram['count']))
+		
+		return ''.join(res)
+	
+	def write_prometheus(self, target):
+		""" Writes prometheus_text() to target: a file name (replaced atomically where the platform allows it),
+		a socket, or a file-like object """
+		
+		text = self.prometheus_text()
+		if isinstance(target, (str, _compat_str)):
+			tmpname = target + '.tmp'
+			f = open(tmpname, 'w')
+			try:
+				f.write(text)
+			finally:
+				f.close()
+			os.rename(tmpname, target)
+		elif hasattr(target, 'sendall'):
+			target.sendall(text.encode('utf-8'))
+		else:
+			target.write(text)
+	
+	def start_exporting(self, exporter, interval=10.0):
+		""" Calls exporter with this object every interval seconds (and once more when stopped), until stop_exporting() """
+		
+		self.stop_exporting()
+		should_stop = self._exporter_should_stop = ThreadAdvertiser._createEvent()
+		
+		def export():
+			while not should_stop.is_set():
+				should_stop.wait(interval)
+				exporter(self)
+		
+		t = threading.Thread(target=export)
+		t.setDaemon(True)
+		t.start()
+	
+	def stop_exporting(self):
+		if self._exporter_should_stop != None:
+			self._exporter_should_stop.set()
+			self._exporter_should_stop = None
+
+class _NullMetrics(object):
+	""" The default metrics, which record nothing """
+	
+	enabled = False
+	
+	def count(self, name, n=1):
+		pass
+	
+	def observe(self, name, seconds):
+		pass
+
+_NULL_METRICS = _NullMetrics()
 
 class ConcurrentAdvertiser(Advertiser):
 	# Subclasses must set _cav_started to an event
@@ -257,6 +916,9 @@ class ConcurrentAdvertiser(Advertiser):
 		raise NotImplementedError()
 
 class ThreadAdvertiser(ConcurrentAdvertiser, threading.Thread):
+	""" An advertiser in a thread of its own. stop() wakes the thread up, which then says goodbye, leaves the
+	multicast groups and closes its socket; stop_blocking() also waits for that. """
+	
 	def __init__(self, services=[], aname=None, ignore_unavailable=True, daemon=True):
 		ConcurrentAdvertiser.__init__(self, services, aname, ignore_unavailable)
 		threading.Thread.__init__(self)
@@ -265,24 +927,48 @@ class ThreadAdvertiser(ConcurrentAdvertiser, threading.Thread):
 		
 		self._cav_started = self._createEvent()
 		self._ta_should_stop = self._createEvent()
+		self._wakeup_sock = None
 	
 	def run(self):
 		self._ta_should_stop.clear()
 		
-		self._init_advertiser()
-		
-		while True:
-			rawdata,sender = self._sock.recvfrom(_MAX_PACKET_SIZE)
-			if self._ta_should_stop.is_set():
-				break
-			self._handle_packet(rawdata, sender)
+		wakeup,self._wakeup_sock = _wakeup_socks()
+		try:
+			self._init_advertiser()
+			try:
+				self._init_batching()
+				self._start_bulk_server()
+				self._start_announcer()
+				
+				while not self._ta_should_stop.is_set():
+					readable = select.select([self._sock, wakeup], [], [])[0]
+					if self._sock in readable and not self._ta_should_stop.is_set():
+						self._handle_packets(self._recv_packets())
+			finally:
+				try:
+					self._stop_announcer()
+				finally:
+					self._close_advertiser()
+		finally:
+			self._wakeup_sock = None
+			wakeup.close()
 	
 	def stop(self):
 		self._ta_should_stop.set()
+		
+		wakeup = self._wakeup_sock
+		if wakeup != None:
+			try:
+				wakeup.send(_compat_bytes('\0'))
+				wakeup.close()
+			except socket.error: # The thread has already stopped
+				pass
 	
 	def stop_blocking(self):
 		""" Stop the service and wait for it to be cleaned up. """
-		self.stop() # The thread will be there, but will terminate upon the next message
+		self.stop()
+		if self.is_alive() and threading.current_thread() is not self:
+			self.join()
 	
 	@staticmethod
 	def _createEvent():
@@ -293,48 +979,339 @@ class ThreadAdvertiser(ConcurrentAdvertiser, threading.Thread):
 		
 		return res
 
-try:
-	import multiprocessing
+# Optional subsystems with slow imports are only defined when one of their names is first accessed
+_LAZY_LOADERS = {} # name -> function defining it
+_lazy_loaded = set()
+_lazy_lock = threading.Lock()
+
+def __getattr__(name):
+	""" Defines lazily loaded names on first access (Python 3.7+, older versions load everything on import) """
+	
+	loader = _LAZY_LOADERS.get(name)
+	if loader != None:
+		_lazy_lock.acquire()
+		try:
+			if not loader in _lazy_loaded:
+				loader()
+				_lazy_loaded.add(loader)
+		finally:
+			_lazy_lock.release()
+		
+		if name in globals():
+			return globals()[name]
+	
+	raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
+
+def _load_multiprocessing():
+	""" Defines the advertisers based on multiprocessing, whose import is slow """
+	global multiprocessing, shared_memory, _SharedCatalog, _attach_shared_memory, _SharedServicesAdvertiser, MultiprocessingAdvertiser, ShardedAdvertiser, _ShardWorker, _shard_of
+	
+	try:
+		import multiprocessing
+	except ImportError: # Python < 2.6
+		return
+	
+	try:
+		from multiprocessing import shared_memory
+	except ImportError: # Python < 3.8
+		shared_memory = None
+	
+	class _SharedCatalog(object):
+		""" The services and name of an advertiser in shared memory, so that another process can read them without IPC.
+		Every update is written to a new segment (copy-on-write) in the format of an aggregated advertisement.
+		A small control segment holds a version number and the name of the current segment;
+		the version is odd while they are being updated, so that readers can detect torn reads.
+		The process that creates a _SharedCatalog writes to it, the ones that attach to it by name only read.
+		"""
+		
+		_CONTROL = struct.Struct('!Q64s')
+		
+		def __init__(self, name=None):
+			self.owner = name == None
+			if self.owner:
+				self._control = shared_memory.SharedMemory(create=True, size=self._CONTROL.size)
+				self._control.buf[:self._CONTROL.size] = self._CONTROL.pack(0, _compat_bytes(''))
+			else:
+				self._control = _attach_shared_memory(name)
+			self.name = self._control.name
+			self._segment = None
+		
+		def __reduce__(self):
+			return (_SharedCatalog, (self.name,))
+		
+		def version(self):
+			return struct.unpack_from('!Q', self._control.buf, 0)[0]
+		
+		def publish(self, aname, services):
+			catalog = _Catalog(aname, services)
+			data = (_MAGIC + _OPCODE_ADVERTISEMENTS + _encode_string(aname) +
+				_compat_bytes('').join(entry[3] for entry in catalog.lookup('', '')))
+			
+			segment = shared_memory.SharedMemory(create=True, size=4 + len(data))
+			segment.buf[:4 + len(data)] = struct.pack('!I', len(data)) + data
+			
+			version = self.version()
+			struct.pack_into('!Q', self._control.buf, 0, version + 1)
+			self._control.buf[:self._CONTROL.size] = self._CONTROL.pack(version + 1, segment.name.encode('ascii'))
+			struct.pack_into('!Q', self._control.buf, 0, version + 2)
+			
+			old,self._segment = self._segment,segment
+			if old != None: # Readers that already mapped it keep their mapping
+				old.close()
+				old.unlink()
+		
+		def read(self):
+			""" Returns a tupel (version, aname, list of services) """
+			
+			while True:
+				version,name = self._CONTROL.unpack_from(self._control.buf, 0)
+				if version % 2 == 1 or self.version() != version:
+					time.sleep(0) # Being updated
+					continue
+				if version == 0:
+					return (0, '', [])
+				
+				try:
+					segment = _attach_shared_memory(name.rstrip(_compat_bytes('\x00')).decode('ascii'))
+				except (OSError, IOError): # Replaced in the meantime
+					continue
+				try:
+					size = struct.unpack_from('!I', segment.buf, 0)[0]
+					data = bytes(segment.buf[4:4 + size])
+				finally:
+					segment.close()
+				
+				services = []
+				aname = _decode_string(data, _HEADER_SIZE)[0]
+				for aname,stype,sname,location,port,payload in _decode_records(data):
+					services.append(Service(stype, port, sname, location))
+				return (version, aname, services)
+		
+		def close(self):
+			for segment in (self._segment, self._control):
+				if segment != None:
+					segment.close()
+					if self.owner:
+						segment.unlink()
+			self._segment = None
+	
+	def _attach_shared_memory(name):
+		try:
+			return shared_memory.SharedMemory(name, track=False)
+		except TypeError: # Python < 3.13 always tracks segments. Readers share the writer's resource tracker, so that is harmless.
+			return shared_memory.SharedMemory(name)
+	
+	class _SharedServicesAdvertiser(Advertiser):
+		""" An advertiser that publishes its services and aname to _shared_catalog (if set) whenever they change """
+		
+		def _set_services(self, services):
+			Advertiser._set_services(self, services)
+			if isinstance(self._services, _ServiceList):
+				self._services.on_change = self._publish
+			self._publish()
+		services = property(fget=lambda self:self._services, fset=_set_services)
+		
+		def _set_aname(self, aname):
+			Advertiser._set_aname(self, aname)
+			self._publish()
+		aname = property(fget=lambda self:self._aname, fset=_set_aname)
+		
+		def _publish(self):
+			if self._shared_catalog != None and self._shared_catalog.owner and hasattr(self, '_aname'):
+				self._shared_catalog.publish(self.aname, self.services)
+		
+		def _goodbye_from_here(self):
+			""" Sends the goodbye from this process, for advertiser processes that cannot do that anymore """
+			
+			if self.announce_schedule:
+				sock = _find_sock()
+				try:
+					self._goodbye(sock)
+				finally:
+					sock.close()
 	
-	class MultiprocessingAdvertiser(ConcurrentAdvertiser, multiprocessing.Process):
+	class MultiprocessingAdvertiser(ConcurrentAdvertiser, _SharedServicesAdvertiser, multiprocessing.Process):
 		"""
 		multiprocessing is only available for Python 2.6+.
 		See http://code.google.com/p/python-multiprocessing/ for a backport.
+		
+		With Python 3.8+, the services are passed to the advertiser process in shared memory, updated whenever
+		services (a list) or aname change. The advertiser process only checks a version number before answering a query.
+		Older versions share the services through a multiprocessing.Manager, at the cost of IPC for every query.
 		"""
 		def __init__(self, services=[], aname=None, ignore_unavailable=True, daemon=True):
+			self._shared_catalog = None
 			ConcurrentAdvertiser.__init__(self, services, aname, ignore_unavailable)
 			multiprocessing.Process.__init__(self)
 			
 			self.daemon = daemon
 			self._cav_started = multiprocessing.Event()
 			
-			self._mpa_manager = multiprocessing.Manager()
-			self.services = self._mpa_manager.list(services)
+			if shared_memory != None:
+				self._shared_catalog = _SharedCatalog()
+				self._publish()
+			else:
+				self._mpa_manager = multiprocessing.Manager()
+				self.services = self._mpa_manager.list(services)
+		
+		def run(self):
+			if self._shared_catalog != None:
+				self._shared_catalog = _SharedCatalog(self._shared_catalog.name)
+			super(MultiprocessingAdvertiser, self).run()
+		
+		def _get_catalog(self):
+			shared = self._shared_catalog
+			if shared == None or shared.owner:
+				return super(MultiprocessingAdvertiser, self)._get_catalog()
+			
+			catalog = self._catalog
+			if catalog == None or catalog.version != shared.version():
+				version,aname,services = shared.read()
+				catalog = self._catalog = _Catalog(aname, services, version)
+			return catalog
 		
 		def stop(self):
 			self.terminate()
+			self._goodbye_from_here()
 		
 		def stop_blocking(self):
 			self.stop()
 			self.join()
-except ImportError:
-	pass
+			if self._shared_catalog != None:
+				self._shared_catalog.close()
+				self._shared_catalog = None
+	
+	class ShardedAdvertiser(_SharedServicesAdvertiser):
+		""" Answers queries with a number of worker processes (default: one per CPU), for more queries than one process can handle.
+		Requires Linux 3.9+ (SO_REUSEPORT) and Python 3.8+ (shared memory).
+		
+		Every worker has its own socket for unicast queries, all bound to the same port with SO_REUSEPORT,
+		so that the kernel distributes these queries by a hash of their sender. Multicast queries reach every worker;
+		each one answers those from the senders in its share, determined by a CRC of the sender's address and port.
+		The services are shared with the workers as in MultiprocessingAdvertiser. Only the first worker sends announcements.
+		
+		start_blocking() returns once all workers are ready, stop_blocking() once they are gone.
+		queries_per_worker() returns the number of queries each worker has answered, to check the distribution.
+		"""
+		
+		def __init__(self, services=[], aname=None, workers=None, ignore_unavailable=True, daemon=True):
+			self._shared_catalog = None
+			_SharedServicesAdvertiser.__init__(self, services, aname, ignore_unavailable)
+			
+			self.workers = workers if workers != None else multiprocessing.cpu_count()
+			self.daemon = daemon
+			self._processes = []
+			self._shared_catalog = _SharedCatalog()
+			self._publish()
+		
+		def run(self):
+			self.start_blocking()
+			for p in self._processes:
+				p.join()
+		
+		def start_blocking(self):
+			self._processes = [_ShardWorker(self, i) for i in range(self.workers)]
+			for p in self._processes:
+				p.start()
+			for p in self._processes:
+				p.wait_until_ready()
+		
+		def stop_blocking(self):
+			for p in self._processes:
+				p.terminate()
+			for p in self._processes:
+				p.join()
+			self._goodbye_from_here()
+			
+			self._shared_catalog.close()
+			self._shared_catalog = None
+		
+		def queries_per_worker(self):
+			return [p.handled.value for p in self._processes]
+	
+	class _ShardWorker(MultiprocessingAdvertiser):
+		""" One of the processes of a ShardedAdvertiser """
+		
+		def __init__(self, sharded, index):
+			self._shared_catalog = None
+			ConcurrentAdvertiser.__init__(self, [], sharded.aname, sharded.ignore_unavailable)
+			multiprocessing.Process.__init__(self)
+			
+			self.daemon = sharded.daemon
+			self._cav_started = multiprocessing.Event()
+			self._shared_catalog = sharded._shared_catalog
+			
+			self.port = sharded.port
+			self.addresses = sharded.addresses
+			self.query_filter = sharded.query_filter
+			self.announce_schedule = sharded.announce_schedule if index == 0 else ()
+			self.announce_interval = sharded.announce_interval
+			self.index = index
+			self.count = sharded.workers
+			self.handled = multiprocessing.RawValue('L', 0)
+		
+		def _init_advertiser(self):
+			try:
+				sock = _find_sock()
+				_reuse_port(sock)
+				sock.bind(('', self.port))
+				self._sock = sock
+				self._group_socks = _listen_socks(self.addresses, self.port, sock.family)
+			finally:
+				self._cav_started.set()
+		
+		def _recv_packets(self):
+			res = []
+			for sock in select.select([self._sock] + self._group_socks, [], [])[0]:
+				rawdata,sender = sock.recvfrom(_MAX_PACKET_SIZE)
+				if sock is self._sock or _shard_of(sender, self.count) == self.index:
+					res.append((rawdata, sender))
+			
+			self.handled.value += len(res)
+			return res
+	
+	def _shard_of(sender, count):
+		""" Returns the index of the worker in charge of multicast packets from sender """
+		return zlib.crc32(('%s %d' % (sender[0], sender[1])).encode('ascii')) % count
+
+_LAZY_LOADERS.update(dict.fromkeys(['multiprocessing', 'shared_memory', '_SharedCatalog', '_attach_shared_memory', '_SharedServicesAdvertiser', 'MultiprocessingAdvertiser', 'ShardedAdvertiser', '_ShardWorker', '_shard_of'], _load_multiprocessing))
 
 
-class Seeker(threading.Thread):
-	""" find_callback is called with (this_seeker,found_service_at)
+class _SeekerBase(object):
+	""" The parts of a seeker that do not depend on how it waits for replies.
+	find_callback is called with (this_seeker,found_service_at)
 	error_callback is called with (this seeker, sender, error message)
+	
+	A seek ends after timeout seconds, or earlier:
+	as soon as max_results results have been found (use 1 to stop at the first result), or
+	when no new result has arrived for idle_timeout seconds (counted from the start of the seek).
+	
+	To cope with lost packets, the queries are repeated during the seek at the times (in seconds after the start,
+	the first one being 0) in retransmit_schedule, as long as they are before the timeout.
+	After a seek, retransmits is the number of repetitions sent, and retransmits_needed the number of repetitions
+	that had been sent when the last new result arrived.
+	Repeated queries list the results found so far, so that advertisers only answer with new or changed services.
+	Queries state that aggregated advertisements are understood, so that advertisers can answer with fewer packets.
+	
+	Set metrics to a Metrics object to count queries, packets and results, and to measure the time spent per packet.
+	
+	Set encoding to 2 to send queries in the v2 encoding. Advertisers of this version answer them in kind, older ones ignore them.
+	Replies are understood in both encodings.
 	"""
-	def __init__(self, stype='', aname='', sname='', timeout=_SEEKER_TIMEOUT, port=_PORT, addresses=_ADDRESSES, find_callback=None, error_callback=None, daemonized=True, ignore_senderrors=True):
-		super(Seeker, self).__init__()
-		
+	def __init__(self, stype='', aname='', sname='', timeout=_SEEKER_TIMEOUT, port=_PORT, addresses=_ADDRESSES, find_callback=None, error_callback=None, ignore_senderrors=True, max_results=None, idle_timeout=None):
 		self.timeout = timeout
 		self.port = port
 		self.addresses = addresses
 		self.find_callback = find_callback
 		self.error_callback = error_callback
-		self.setDaemon(daemonized)
 		self.ignore_senderrors = ignore_senderrors
+		self.max_results = max_results
+		self.idle_timeout = idle_timeout
+		self.retransmit_schedule = _RETRANSMIT_SCHEDULE
+		self.metrics = _NULL_METRICS
+		self.accept_bulk = False
+		self.encoding = 1
+		self.context = None
 		self.reset(stype, aname, sname)
 	
 	def reset(self, stype='', aname='', sname=''):
@@ -351,127 +1328,1093 @@ class Seeker(threading.Thread):
 		_check_val(aname)
 		self._aname = aname
 	aname = property(fget=lambda self:self._aname, fset=_set_aname)
-
+	
 	def _set_sname(self, sname):
 		_check_val(sname)
 		self._sname = sname
 	sname = property(fget=lambda self:self._sname, fset=_set_sname)
 	
-	def run(self):
-		self._init_seeker()
-		
-		if self._send_queries() > 0:
-			self._read_replies()
+	def _init_seeker(self):
+		self._init_results()
 		
-		return self.results
+		if self.context != None:
+			self._sock = self.context._socket()
+		else:
+			self._sock = _find_sock()
+			_multicast_configure_sender(self._sock, _TTL)
 	
-	def run_forever(self):
-		self.timeout = None
-		self.run()
-	
-	def _init_seeker(self):
+	def _init_results(self):
 		self.results = set()
+		self._digests = {} # result -> digest of its advertisement
+		self.retransmits = 0
+		self.retransmits_needed = 0
+		self._start_time = self._last_result_time = time.time()
+		self._bulk_offers = set() # (address, port) of the bulk transfers done
+		self._bulk_failed = False
+	
+	def _remaining_time(self):
+		""" Returns the number of seconds until the seek is over (<= 0 if it is), or None for no limit """
+		
+		if self.max_results != None and len(self.results) >= self.max_results:
+			return 0
+		
+		now = time.time()
+		res = None
+		if self.timeout != None:
+			res = self.timeout - (now - self._start_time)
+		if self.idle_timeout != None:
+			idle = self.idle_timeout - (now - self._last_result_time)
+			res = idle if res == None else min(res, idle)
 		
-		self._sock = _find_sock()
-		_multicast_configure_sender(self._sock, _TTL)
+		return res
 	
-	def _send_queries(self):
-		""" Sends queries to multiple addresses. Returns the number of successful queries. """
+	def _next_retransmit(self):
+		""" Returns the number of seconds until the next repetition of the queries is due, or None if there is none left """
+		
+		schedule = self.retransmit_schedule
+		if self.retransmits + 1 >= len(schedule):
+			return None
+		
+		offset = schedule[self.retransmits + 1]
+		if self.timeout != None and offset >= self.timeout:
+			return None
+		
+		return offset - (time.time() - self._start_time)
+	
+	def _retransmit(self):
+		self.retransmits += 1
+		self._send_queries()
+	
+	def _send_queries(self, addrs=None):
+		""" Sends queries to multiple addresses (default: the resolved addresses). Returns the number of successful queries. """
 		
 		res = 0
 		
-		addrs = _resolve_addrs(self.addresses, self.port, self.ignore_senderrors, [self._sock.family])
+		if addrs != None:
+			pass
+		elif self.context != None:
+			addrs = self.context._resolve(self.addresses, self.port, self.ignore_senderrors, self._sock.family)
+		else:
+			addrs = _resolve_addrs(self.addresses, self.port, self.ignore_senderrors, [self._sock.family])
 		for addr in addrs:
 			try:
 				self._send_query(addr[1])
 				res += 1
 			except:
+				self.metrics.count('send_errors')
 				if not self.ignore_senderrors:
 					raise
 		
 		return res
 	
 	def _send_query(self, to):
-		binqry = _encode_string(self.aname)
-		binqry += _encode_string(self.stype)
-		binqry += _encode_string(self.sname)
+		accepted = _OPCODE_ADVERTISEMENTS
+		if self.accept_bulk and not self._bulk_failed:
+			accepted += _OPCODE_BULK_OFFER
 		
-		_send_packet(self._sock, to, _OPCODE_QUERY, binqry)
+		self._sock.sendto(self._encode_query(accepted), 0, to)
+		self.metrics.count('queries_sent')
 	
-	def _read_replies(self):
-		if self.timeout == None:
-			self._sock.settimeout(None)
+	def _encode_query(self, accepted):
+		""" Returns a query packet, in the v2 encoding if encoding is 2 """
+		
+		if self.encoding == 2:
+			binqry = _MAGIC + _OPCODE_V2 + _OPCODE_QUERY + _encode_fields([self.aname, self.stype, self.sname])
 		else:
-			starttime = time.time()
+			binqry = _MAGIC + _OPCODE_QUERY
+			binqry += _encode_string(self.aname)
+			binqry += _encode_string(self.stype)
+			binqry += _encode_string(self.sname)
 		
-		while True:
-			if self.timeout != None:
-				timeout = self.timeout - (time.time() - starttime)
-				if timeout < 0:
-					break
-				
-				self._sock.settimeout(timeout)
-			
-			try:
-				rawdata,sender = self._sock.recvfrom(_MAX_PACKET_SIZE)
-			except socket.timeout:
-				break
-			
-			self._handle_packet(rawdata, sender)
+		binqry += _encode_extension(_EXT_ACCEPTED_OPCODES, accepted)
+		
+		# As many known answers as fit; the advertisers will send the others again
+		space = _MAX_PACKET_SIZE - len(binqry) - _EXTENSION_HEADER.size
+		known = self._known_answers()[:max(0, space // _DIGEST_SIZE)]
+		if known:
+			binqry += _encode_extension(_EXT_KNOWN_ANSWERS, _compat_bytes('').join(known))
+		
+		return binqry
+	
+	def _known_answers(self):
+		""" Returns a list of the digests of the advertisements the advertisers need not send again """
+		return list(set(self._digests.values()))
 	
 	def _handle_packet(self, rawdata, sender):
+		metrics = self.metrics
+		metrics.count('packets_received')
+		if not metrics.enabled:
+			self._process_packet(rawdata, sender)
+			return
+		
+		start = time.time()
+		self._process_packet(rawdata, sender)
+		metrics.observe('packet_seconds', time.time() - start)
+	
+	def _process_packet(self, rawdata, sender):
+		opcode = _packet_opcode(rawdata)
 		try:
-			opcode,data = _parse_packet(rawdata)
-			
 			if opcode == _OPCODE_ADVERTISEMENT:
-				self._handle_advertisement(data, sender)
+				self._handle_advertisement(rawdata, sender)
+			elif opcode == _OPCODE_ADVERTISEMENTS or opcode == _OPCODE_ANNOUNCEMENT:
+				self._handle_advertisements(rawdata, sender)
+			elif opcode == _OPCODE_GOODBYE:
+				self._handle_goodbye(rawdata, sender)
+			elif opcode == _OPCODE_BULK_OFFER:
+				self._handle_bulk_offer(rawdata, sender)
 			elif opcode == _OPCODE_ERROR:
 				try:
-					error_str = _decode_string(data, 0)[0]
+					error_str = _decode_payload(rawdata, 1)[0][0]
 				except:
-					error_str = '[Error when trying to read error message ' + repr(data) + ']'
+					error_str = '[Error when trying to read error message ' + repr(rawdata[_HEADER_SIZE:]) + ']'
 				
+				self.metrics.count('errors_received')
 				if self.error_callback != None:
 					self.error_callback(self, sender, error_str)
+			elif opcode == None:
+				self.metrics.count('packets_rejected')
 			else: # Invalid opcode
-				pass
+				self.metrics.count('packets_malformed')
 		except MinusconfError: # Invalid packet
-			pass
+			self.metrics.count('packets_malformed')
 	
-	def _handle_advertisement(self, bindata, sender):
-		aname,p = _decode_string(bindata, 0)
-		stype,p = _decode_string(bindata, p)
-		sname,p = _decode_string(bindata, p)
-		location,p = _decode_string(bindata, p)
-		port,p = _decode_string(bindata, p)
+	def _handle_advertisement(self, rawdata, sender):
+		if _is_v2(rawdata): # Laid out like an aggregated advertisement with a single service
+			self._handle_advertisements(rawdata, sender)
+			return
+		
+		(aname, stype, sname, location, port),p = _decode_strings(rawdata, _HEADER_SIZE, 5)
+		self._advertised(aname, stype, sname, location, port, sender, rawdata[_HEADER_SIZE:p])
+	
+	def _handle_advertisements(self, rawdata, sender):
+		for aname,stype,sname,location,port,payload in _decode_records(rawdata):
+			self._advertised(aname, stype, sname, location, port, sender, payload)
+	
+	def _handle_bulk_offer(self, rawdata, sender):
+		""" Fetches the services from a bulk offer over TCP. If that fails, asks again without accepting bulk offers. """
+		
+		(aname, count, port),p = _decode_payload(rawdata, 3)
+		if not self.accept_bulk or not _string_match(self.aname, aname):
+			return
+		
+		# Offers come for every multicast group, and for repeated queries whose known answers did not all fit
+		key = (sender[0], port)
+		if key in self._bulk_offers:
+			return
+		self._bulk_offers.add(key)
+		
+		try:
+			self._fetch_bulk((sender[0], int(port)) + tuple(sender[2:]), sender)
+			self.metrics.count('bulk_transfers')
+		except (socket.error, ValueError):
+			self.metrics.count('bulk_errors')
+			self._bulk_failed = True
+			self._send_queries()
+	
+	def _fetch_bulk(self, addr, sender):
+		conn = socket.socket(self._sock.family, socket.SOCK_STREAM)
+		try:
+			conn.settimeout(_BULK_TIMEOUT)
+			conn.connect(addr)
+			query = self._encode_query(_OPCODE_ADVERTISEMENTS)
+			conn.sendall(_FRAME_HEADER.pack(len(query)) + query)
+			
+			while True:
+				remaining = self._remaining_time()
+				if remaining != None and remaining <= 0:
+					break
+				
+				rawdata = _recv_frame(conn)
+				if rawdata == None:
+					raise socket.error('Bulk transfer from ' + str(addr) + ' ended early')
+				if not rawdata: # The end
+					break
+				if _packet_opcode(rawdata) == _OPCODE_ADVERTISEMENTS:
+					self._handle_advertisements(rawdata, sender)
+		finally:
+			conn.close()
+	
+	def _handle_goodbye(self, rawdata, sender):
+		gone = set()
+		try:
+			for aname,stype,sname,location,port,payload in _decode_records(rawdata):
+				gone.add(_digest(payload))
+		finally: # Even if a record is malformed, the ones before it are gone
+			for result,digest in list(self._digests.items()):
+				if digest in gone:
+					self._lost_result(result)
+	
+	def _advertised(self, aname, stype, sname, location, port, sender, payload):
+		""" Handles one advertised service. payload are its encoded fields, from which the digest is computed. """
 		
 		if stype == '': # servicetype must be non-empty
 			return
 		
-		svca = ServiceAt(aname, stype, sname, location, port, sender[0])
+		self.metrics.count('advertisements_received')
+		self._advertised_at(ServiceAt(aname, stype, sname, location, port, sender[0]), payload)
+	
+	def _advertised_at(self, svca, payload):
 		if svca.matches_query_at(self.aname, self.stype, self.sname):
+			if not (svca in self._digests):
+				self._digests[svca] = _digest(payload)
 			self._found_result(svca)
 	
 	def _found_result(self, result):
-		if not (result in self.results):
-			self.results.add(result)
-			if self.find_callback != None:
-				self.find_callback(self, result)
+		""" Returns whether result is new """
+		
+		if result in self.results:
+			return False
+		if self.max_results != None and len(self.results) >= self.max_results: # Aggregated advertisements can bring more
+			return False
+		
+		self.results.add(result)
+		self._last_result_time = time.time()
+		self.retransmits_needed = self.retransmits
+		self.metrics.count('results_found')
+		if self.find_callback != None:
+			self.find_callback(self, result)
+		
+		return True
+	
+	def _lost_result(self, result):
+		""" Called when the advertiser of result said goodbye """
+		
+		self.results.discard(result)
+		self._digests.pop(result, None)
+
+class Seeker(_SeekerBase, threading.Thread):
+	""" A seeker running in its own thread. Call run() to seek in the current thread.
+	find_callback is called with (this_seeker,found_service_at)
+	error_callback is called with (this seeker, sender, error message)
+	If context is a SeekerContext, its socket and resolved addresses are used instead of new ones.
+	If accept_bulk is set (the default), advertisers with many matching services can offer a bulk transfer over TCP,
+	which the seeker then performs.
+	"""
+	def __init__(self, stype='', aname='', sname='', timeout=_SEEKER_TIMEOUT, port=_PORT, addresses=_ADDRESSES, find_callback=None, error_callback=None, daemonized=True, ignore_senderrors=True, max_results=None, idle_timeout=None, context=None):
+		_SeekerBase.__init__(self, stype, aname, sname, timeout, port, addresses, find_callback, error_callback, ignore_senderrors, max_results, idle_timeout)
+		threading.Thread.__init__(self)
+		
+		self.context = context
+		self.accept_bulk = True
+		self.setDaemon(daemonized)
+	
+	def run(self):
+		self._init_seeker()
+		
+		if self.context != None:
+			self._inbox = self.context._register()
+		try:
+			if self._send_queries() > 0:
+				self._read_replies()
+		finally:
+			if self.context != None:
+				self.context._unregister(self._inbox)
+		
+		return self.results
+	
+	def run_forever(self):
+		self.timeout = None
+		self.max_results = None
+		self.idle_timeout = None
+		self.run()
+	
+	def _read_replies(self):
+		while True:
+			timeout = self._remaining_time()
+			if timeout != None and timeout <= 0:
+				break
+			
+			retransmit = self._next_retransmit()
+			if retransmit != None and (timeout == None or retransmit < timeout):
+				if retransmit <= 0:
+					self._retransmit()
+					continue
+				timeout = retransmit
+			
+			try:
+				rawdata,sender = self._receive(timeout)
+			except socket.timeout:
+				continue
+			
+			self._handle_packet(rawdata, sender)
+	
+	def _receive(self, timeout):
+		""" Returns the next packet as (rawdata, sender), or raises socket.timeout """
+		
+		if self.context != None:
+			try:
+				return self._inbox.get(True, timeout)
+			except _compat_queue.Empty:
+				raise socket.timeout()
+		
+		self._sock.settimeout(timeout)
+		return self._sock.recvfrom(_MAX_PACKET_SIZE)
+
+class SeekerContext(object):
+	""" Lets many seeks, in sequence or in parallel, share one configured socket and the resolved multicast addresses.
+	A dispatcher thread reads the replies and hands every packet to all running seeks; each of them keeps the results
+	matching its own query. Resolved addresses are reused for resolve_ttl seconds.
+	
+	Use seek(), or pass context=this_context to a Seeker. Call close() when done, or use the context in a with statement.
+	"""
+	def __init__(self, resolve_ttl=60.0):
+		self.resolve_ttl = resolve_ttl
+		
+		self._lock = threading.Lock()
+		self._sock = None
+		self._dispatcher = None
+		self._closed = False
+		self._inboxes = []
+		self._resolved = {} # (addresses, port, ignore_unavailable, family) -> (resolution time, resolved addresses)
+	
+	def seek(self, stype='', aname='', sname='', **kwargs):
+		""" Seeks in the current thread and returns the results. kwargs are passed to Seeker. """
+		return Seeker(stype, aname, sname, context=self, **kwargs).run()
+	
+	def close(self):
+		self._lock.acquire()
+		try:
+			self._closed = True
+			dispatcher = self._dispatcher
+		finally:
+			self._lock.release()
+		
+		if dispatcher != None:
+			dispatcher.join()
+		if self._sock != None:
+			self._sock.close()
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+	
+	def _socket(self):
+		""" Returns the shared socket, creating it and starting the dispatcher on first use """
+		
+		self._lock.acquire()
+		try:
+			if self._closed:
+				raise MinusconfError('SeekerContext has been closed')
+			
+			if self._sock == None:
+				sock = _find_sock()
+				_multicast_configure_sender(sock, _TTL)
+				sock.settimeout(_DISPATCH_INTERVAL)
+				self._sock = sock
+				
+				self._dispatcher = threading.Thread(target=self._dispatch)
+				self._dispatcher.setDaemon(True)
+				self._dispatcher.start()
+			
+			return self._sock
+		finally:
+			self._lock.release()
+	
+	def _resolve(self, addresses, port, ignore_unavailable, family):
+		key = (tuple(addresses), port, ignore_unavailable, family)
+		now = time.time()
+		
+		entry = self._resolved.get(key)
+		if entry == None or now - entry[0] >= self.resolve_ttl:
+			entry = self._resolved[key] = (now, _resolve_addrs(addresses, port, ignore_unavailable, [family]))
+		
+		return entry[1]
+	
+	def _register(self):
+		""" Returns a queue that receives all packets until it is unregistered """
+		
+		inbox = _compat_queue.Queue()
+		self._lock.acquire()
+		try:
+			self._inboxes.append(inbox)
+		finally:
+			self._lock.release()
+		return inbox
+	
+	def _unregister(self, inbox):
+		self._lock.acquire()
+		try:
+			self._inboxes.remove(inbox)
+		finally:
+			self._lock.release()
+	
+	def _dispatch(self):
+		while not self._closed:
+			try:
+				packet = self._sock.recvfrom(_MAX_PACKET_SIZE)
+			except socket.timeout:
+				continue
+			except socket.error: # For example, ICMP errors for earlier queries on Windows
+				continue
+			
+			self._lock.acquire()
+			try:
+				inboxes = list(self._inboxes)
+			finally:
+				self._lock.release()
+			
+			for inbox in inboxes:
+				inbox.put(packet)
+
+class SeekerPool(object):
+	""" Seeks for many queries at once, over a single socket in the current thread, until a shared deadline.
+	add() a query for every (stype, aname, sname); it returns the query, whose results can be read after run().
+	run() sends all queries and returns a list of their result sets, in the order they were added.
+	Every advertisement is handed to all queries it matches.
+	
+	timeout, retransmit_schedule and max_results (for every query) work as with a Seeker;
+	run() returns early once every query has max_results results.
+	find_callback is called with (query, found_service_at), error_callback with (this pool, sender, error message).
+	"""
+	
+	def __init__(self, timeout=_SEEKER_TIMEOUT, port=_PORT, addresses=_ADDRESSES, find_callback=None, error_callback=None, ignore_senderrors=True, max_results=None):
+		self.timeout = timeout
+		self.port = port
+		self.addresses = addresses
+		self.find_callback = find_callback
+		self.error_callback = error_callback
+		self.ignore_senderrors = ignore_senderrors
+		self.max_results = max_results
+		self.retransmit_schedule = _RETRANSMIT_SCHEDULE
+		self.metrics = _NULL_METRICS
+		self.queries = []
+	
+	def add(self, stype='', aname='', sname=''):
+		query = _SeekerBase(stype, aname, sname, port=self.port, addresses=self.addresses, ignore_senderrors=self.ignore_senderrors)
+		self.queries.append(query)
+		return query
+	
+	def run(self):
+		sock = _find_sock()
+		try:
+			_multicast_configure_sender(sock, _TTL)
+			try:
+				sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _POOL_RCVBUF)
+			except socket.error: # The system's limit applies
+				pass
+			addrs = _resolve_addrs(self.addresses, self.port, self.ignore_senderrors, [sock.family])
+			
+			self._by_stype = {} # stype of the query -> queries
+			for query in self.queries:
+				query.timeout = self.timeout
+				query.max_results = self.max_results
+				query.retransmit_schedule = self.retransmit_schedule
+				query.find_callback = self.find_callback
+				query.metrics = self.metrics
+				query._sock = sock
+				query._init_results()
+				self._by_stype.setdefault(query.stype, []).append(query)
+			
+			# Replies to the first queries arrive while the others are sent; read them in between so that they do not overflow the socket buffer
+			sent = 0
+			for query in self.queries:
+				sent += query._send_queries(addrs)
+				self._drain(sock)
+			if sent > 0:
+				self._read_replies(sock, addrs)
+		finally:
+			sock.close()
+		
+		return [query.results for query in self.queries]
+	
+	def _drain(self, sock):
+		""" Handles the packets that have already arrived """
+		
+		sock.settimeout(0)
+		while True:
+			try:
+				rawdata,sender = sock.recvfrom(_MAX_PACKET_SIZE)
+			except socket.error: # Includes socket.timeout
+				return
+			self._handle_packet(rawdata, sender)
+	
+	def _read_replies(self, sock, addrs):
+		pending = self.queries
+		while True:
+			pending = [query for query in pending if query._remaining_time() == None or query._remaining_time() > 0]
+			if not pending:
+				break
+			
+			timeout = pending[0]._remaining_time() # The same for all pending queries
+			for query in pending:
+				retransmit = query._next_retransmit()
+				if retransmit != None and retransmit <= 0:
+					query.retransmits += 1
+					query._send_queries(addrs)
+					self._drain(sock)
+				elif retransmit != None and (timeout == None or retransmit < timeout):
+					timeout = retransmit
+			
+			sock.settimeout(timeout)
+			try:
+				rawdata,sender = sock.recvfrom(_MAX_PACKET_SIZE)
+			except socket.timeout:
+				continue
+			
+			self._handle_packet(rawdata, sender)
+	
+	def _handle_packet(self, rawdata, sender):
+		self.metrics.count('packets_received')
+		opcode = _packet_opcode(rawdata)
+		try:
+			if opcode == _OPCODE_ADVERTISEMENT and not _is_v2(rawdata):
+				(aname, stype, sname, location, port),p = _decode_strings(rawdata, _HEADER_SIZE, 5)
+				records = [(aname, stype, sname, location, port, rawdata[_HEADER_SIZE:p])]
+			elif opcode in (_OPCODE_ADVERTISEMENT, _OPCODE_ADVERTISEMENTS, _OPCODE_ANNOUNCEMENT):
+				records = _decode_records(rawdata)
+			elif opcode == _OPCODE_GOODBYE:
+				for query in self.queries:
+					query._handle_goodbye(rawdata, sender)
+				return
+			elif opcode == _OPCODE_ERROR:
+				error_str = _decode_payload(rawdata, 1)[0][0]
+				if self.error_callback != None:
+					self.error_callback(self, sender, error_str)
+				return
+			else:
+				self.metrics.count('packets_rejected' if opcode == None else 'packets_malformed')
+				return
+			
+			wildcards = self._by_stype.get('', [])
+			for aname,stype,sname,location,port,payload in records:
+				if stype == '': # servicetype must be non-empty
+					continue
+				
+				self.metrics.count('advertisements_received')
+				svca = ServiceAt(aname, stype, sname, location, port, sender[0])
+				for query in self._by_stype.get(stype, []) + wildcards:
+					query._advertised_at(svca, payload)
+		except MinusconfError: # Invalid packet
+			self.metrics.count('packets_malformed')
+
+def seek_many(queries, timeout=_SEEKER_TIMEOUT, **kwargs):
+	""" Seeks for all queries at once and returns a list of their result sets.
+	Every query is a servicetype or a tupel (servicetype[, advertisername[, servicename]]). kwargs are passed to SeekerPool. """
+	
+	pool = SeekerPool(timeout, **kwargs)
+	for query in queries:
+		if isinstance(query, (str, _compat_str)):
+			query = (query,)
+		pool.add(*query)
+	return pool.run()
+
+class Browser(Seeker):
+	""" Keeps track of the services matching a query, in a thread of its own.
+	The query is repeated every interval seconds, plus a random share of up to jitter of that so that browsers do not synchronize.
+	Services that have not been advertised for expiry seconds (default: 3 intervals) are removed.
+	
+	last_seen maps the results to the time they were last advertised. At most max_entries services are tracked;
+	beyond that, the one seen longest ago is removed to make room.
+	added_callback and removed_callback are called with (this browser, service_at).
+	stop() ends browsing with the next packet or query.
+	
+	If listen is set (before starting), the browser also receives announcements and goodbyes of advertisers, so that
+	changes are noticed right away instead of with the next query. The sockets for that are bound to the multicast
+	groups, so that they do not take away unicast queries from advertisers on this host; where this is not supported,
+	only queries are used.
+	"""
+	def __init__(self, stype='', aname='', sname='', interval=10.0, expiry=None, max_entries=1024, port=_PORT, addresses=_ADDRESSES, added_callback=None, removed_callback=None, error_callback=None, daemonized=True, ignore_senderrors=True):
+		Seeker.__init__(self, stype, aname, sname, None, port, addresses, added_callback, error_callback, daemonized, ignore_senderrors)
+		
+		self.interval = interval
+		self.expiry = expiry if expiry != None else 3 * interval
+		self.jitter = 0.25
+		self.max_entries = max_entries
+		self.removed_callback = removed_callback
+		self.listen = True
+		self._browser_should_stop = ThreadAdvertiser._createEvent()
+	
+	added_callback = property(fget=lambda self:self.find_callback, fset=lambda self,cb:setattr(self, 'find_callback', cb))
+	
+	def run(self):
+		import random
+		
+		self._browser_should_stop.clear()
+		self._init_seeker()
+		listen_socks = _listen_socks(self.addresses, self.port, self._sock.family) if self.listen else []
+		
+		next_query = time.time()
+		while not self._browser_should_stop.is_set():
+			now = time.time()
+			if now >= next_query:
+				self._start_time = now
+				self.retransmits = 0
+				self._bulk_offers = set()
+				self._send_queries()
+				next_query = now + self.interval * (1 + self.jitter * random.random())
+			
+			self._expire(now)
+			
+			retransmit = self._next_retransmit()
+			if retransmit != None and retransmit <= 0:
+				self._retransmit()
+				continue
+			
+			timeouts = [next_query - now]
+			if retransmit != None:
+				timeouts.append(retransmit)
+			if self.last_seen:
+				timeouts.append(next(iter(self.last_seen.values())) + self.expiry - now)
+			
+			readable = select.select([self._sock] + listen_socks, [], [], max(0, min(timeouts)))[0]
+			for sock in readable:
+				rawdata,sender = sock.recvfrom(_MAX_PACKET_SIZE)
+				self._handle_packet(rawdata, sender)
+		
+		for sock in [self._sock] + listen_socks:
+			sock.close()
+	
+	def stop(self):
+		self._browser_should_stop.set()
+	
+	def _init_seeker(self):
+		Seeker._init_seeker(self)
+		self.last_seen = collections.OrderedDict() # Seen longest ago first
+	
+	def _expire(self, now):
+		limit = now - self.expiry
+		while self.last_seen:
+			result,seen = next(iter(self.last_seen.items()))
+			if seen > limit:
+				break
+			self._remove(result)
+	
+	def _remove(self, result):
+		self.last_seen.pop(result, None)
+		self._digests.pop(result, None)
+		self.results.discard(result)
+		if self.removed_callback != None:
+			self.removed_callback(self, result)
+	
+	def _known_answers(self):
+		""" Only services seen within half the expiry are known answers, so that the others get refreshed in time """
+		
+		limit = time.time() - self.expiry / 2.0
+		fresh = set()
+		stale = set()
+		for result,seen in self.last_seen.items():
+			(fresh if seen > limit else stale).add(self._digests.get(result))
+		
+		return list(fresh - stale) # The same advertisement can arrive from multiple addresses
+	
+	def _lost_result(self, result):
+		if result in self.last_seen:
+			self._remove(result)
+	
+	def _found_result(self, result):
+		known = self.last_seen.pop(result, None) != None
+		self.last_seen[result] = time.time()
+		if known:
+			return False
+		
+		while len(self.last_seen) > max(1, self.max_entries):
+			self._remove(next(iter(self.last_seen)))
+		
+		return Seeker._found_result(self, result)
+
+
+def _load_asyncio():
+	""" Defines the asyncio advertiser and seeker; importing asyncio is slow """
+	global asyncio, _TransportSocket, _AsyncProtocol, AsyncAdvertiser, AsyncSeeker, _AsyncResultIterator
+	
+	try:
+		import asyncio
+	except ImportError: # Python < 3.4
+		return
+	
+	class _TransportSocket(object):
+		""" Lets the packet handlers send through an asyncio datagram transport as if it was a socket """
+		
+		def __init__(self, transport):
+			self._transport = transport
+			self.family = transport.get_extra_info('socket').family
+		
+		def sendto(self, data, flags, to):
+			self._transport.sendto(data, to)
+	
+	class _AsyncProtocol(asyncio.DatagramProtocol):
+		""" Feeds the datagrams of an asyncio transport to an advertiser or seeker """
+		
+		def __init__(self, handler):
+			self._handler = handler
+		
+		def connection_made(self, transport):
+			self._handler._sock = _TransportSocket(transport)
+		
+		def datagram_received(self, data, addr):
+			self._handler._handle_packet(data, addr)
+		
+		def error_received(self, exc):
+			pass # For example ICMP port unreachable from a seeker that already left
+	
+	class AsyncAdvertiser(Advertiser):
+		""" An advertiser in an asyncio event loop. Many of them can share a single loop.
+		await advertiser.start() returns once it is ready, advertiser.stop() closes it.
+		asyncio is only available for Python 3.4+.
+		"""
+		
+		def __init__(self, services=[], aname=None, ignore_unavailable=True, loop=None):
+			super(AsyncAdvertiser, self).__init__(services, aname, ignore_unavailable)
+			
+			self.loop = loop
+			self._transport = None
+			self._announce_timer = None
+		
+		def start(self):
+			""" Returns a future that is done as soon as the advertiser answers queries """
+			
+			loop = self.loop if self.loop != None else asyncio.get_event_loop()
+			
+			self._init_advertiser()
+			self._loop = loop
+			self._sock.setblocking(False)
+			endpoint = asyncio.ensure_future(
+				loop.create_datagram_endpoint(lambda: _AsyncProtocol(self), sock=self._sock), loop=loop)
+			
+			res = loop.create_future()
+			def connected(endpoint):
+				if endpoint.exception() != None:
+					res.set_exception(endpoint.exception())
+				else:
+					self._transport = endpoint.result()[0]
+					self._start_announcer()
+					res.set_result(self)
+			endpoint.add_done_callback(connected)
+			
+			return res
+		
+		def stop(self):
+			if self._transport != None:
+				if self._announce_timer != None:
+					self._announce_timer.cancel()
+					self._announce_timer = None
+					self._goodbye()
+				self._transport.close()
+				self._transport = None
+		
+		def _start_announcer(self):
+			""" Sends the announcements from the event loop instead of a thread """
+			
+			self._init_announcements()
+			if not self.announce_schedule:
+				return
+			
+			def announce():
+				self._announce_timer = self._loop.call_later(self._announce(), announce)
+			announce()
+	
+	class AsyncSeeker(_SeekerBase):
+		""" A seeker in an asyncio event loop. Many of them can share a single loop.
+		results = await seeker.seek() returns the set of results once the timeout expires;
+		async for svca in seeker: ... yields the results as they arrive.
+		"""
+		
+		def __init__(self, stype='', aname='', sname='', timeout=_SEEKER_TIMEOUT, port=_PORT, addresses=_ADDRESSES, find_callback=None, error_callback=None, ignore_senderrors=True, max_results=None, idle_timeout=None, loop=None):
+			_SeekerBase.__init__(self, stype, aname, sname, timeout, port, addresses, find_callback, error_callback, ignore_senderrors, max_results, idle_timeout)
+			
+			self.loop = loop
+			self._done = None
+		
+		def seek(self):
+			""" Starts a seek, unless one is already running. Returns a future of the set of results. """
+			
+			if self._done != None and not self._done.done():
+				return self._done
+			
+			loop = self.loop if self.loop != None else asyncio.get_event_loop()
+			
+			self._init_seeker()
+			self._found = []
+			self._waiters = []
+			self._transport = None
+			self._timer = None
+			self._loop = loop
+			self._done = loop.create_future()
+			
+			self._sock.setblocking(False)
+			endpoint = asyncio.ensure_future(
+				loop.create_datagram_endpoint(lambda: _AsyncProtocol(self), sock=self._sock), loop=loop)
+			endpoint.add_done_callback(self._connected)
+			
+			return self._done
+		
+		def __aiter__(self):
+			self.seek()
+			return _AsyncResultIterator(self)
+		
+		def _connected(self, endpoint):
+			if endpoint.exception() != None:
+				self._finish(endpoint.exception())
+				return
+			
+			self._transport = endpoint.result()[0]
+			try:
+				sent = self._send_queries()
+			except Exception as e:
+				self._finish(e)
+				return
+			
+			if sent == 0:
+				self._finish()
+			else:
+				self._start_time = self._last_result_time = time.time()
+				self._check_time()
+		
+		def _check_time(self):
+			""" Finishes the seek if it is over, and repeats the queries if that is due.
+			Otherwise (re)schedules this check for when one of these might be the case. """
+			
+			if self._timer != None:
+				self._timer.cancel()
+				self._timer = None
+			
+			remaining = self._remaining_time()
+			if remaining != None and remaining <= 0:
+				self._finish()
+				return
+			
+			retransmit = self._next_retransmit()
+			if retransmit != None and retransmit <= 0:
+				try:
+					self._retransmit()
+				except Exception as e:
+					self._finish(e)
+					return
+				retransmit = self._next_retransmit()
+			
+			delays = [d for d in (remaining, retransmit) if d != None]
+			if delays:
+				self._timer = self._loop.call_later(max(0, min(delays)), self._check_time)
+		
+		def _finish(self, exception=None):
+			if self._done.done():
+				return
+			
+			if self._timer != None:
+				self._timer.cancel()
+			if self._transport != None:
+				self._transport.close()
+			
+			if exception != None:
+				self._done.set_exception(exception)
+			else:
+				self._done.set_result(self.results)
+			
+			waiters,self._waiters = self._waiters,[]
+			for it,fut in waiters:
+				if not fut.done():
+					fut.set_exception(exception if exception != None else StopAsyncIteration())
+		
+		def _next_result(self, it):
+			fut = self._loop.create_future()
+			
+			if it._pos < len(self._found):
+				fut.set_result(self._found[it._pos])
+				it._pos += 1
+			elif self._done.done():
+				fut.set_exception(self._done.exception() or StopAsyncIteration())
+			else:
+				self._waiters.append((it, fut))
+			
+			return fut
+		
+		def _found_result(self, result):
+			if not _SeekerBase._found_result(self, result):
+				return False
+			
+			self._found.append(result)
+			waiters,self._waiters = self._waiters,[]
+			for it,fut in waiters:
+				if not fut.done():
+					fut.set_result(result)
+					it._pos += 1
+			
+			if self.max_results != None or self.idle_timeout != None:
+				self._check_time()
+			
+			return True
+	
+	class _AsyncResultIterator(object):
+		""" Asynchronous iterator over the results of an AsyncSeeker, in order of arrival """
+		
+		def __init__(self, seeker):
+			self._seeker = seeker
+			self._pos = 0
+		
+		def __aiter__(self):
+			return self
+		
+		def __anext__(self):
+			return self._seeker._next_result(self)
+
+_LAZY_LOADERS.update(dict.fromkeys(['asyncio', '_TransportSocket', '_AsyncProtocol', 'AsyncAdvertiser', 'AsyncSeeker', '_AsyncResultIterator'], _load_asyncio))
+
+class ServiceCache(object):
+	""" Caches seek results per (aname, stype, sname).
+	Results younger than ttl seconds are returned immediately. Older results are still returned for another
+	stale_ttl seconds (default: ttl), but refreshed in the background. At most max_entries results are kept;
+	the least recently used ones are evicted first. Concurrent callers asking for the same key share a single seek.
+	
+	seeker_factory is called with (stype, aname, sname) and must return an object whose run() method seeks
+	and returns the results. By default, it creates a Seeker with the given timeout.
+	"""
+	
+	def __init__(self, ttl=30.0, max_entries=256, stale_ttl=None, timeout=_SEEKER_TIMEOUT, seeker_factory=None):
+		self.ttl = ttl
+		self.stale_ttl = stale_ttl if stale_ttl != None else ttl
+		self.max_entries = max_entries
+		self.timeout = timeout
+		self.seeker_factory = seeker_factory if seeker_factory != None else self._create_seeker
+		
+		self._lock = threading.Lock()
+		self._entries = collections.OrderedDict() # key -> (results, fetch time), least recently used first
+		self._pending = {} # key -> _PendingSeek
+	
+	def get(self, stype='', aname='', sname=''):
+		""" Returns a frozenset of the ServiceAt objects found for the query """
+		
+		key = (aname, stype, sname)
+		
+		self._lock.acquire()
+		try:
+			entry = self._entries.get(key)
+			if entry != None:
+				results,fetched = entry
+				age = time.time() - fetched
+				if age < self.ttl + self.stale_ttl:
+					self._touch(key)
+					if age >= self.ttl and not key in self._pending:
+						pending = self._pending[key] = _PendingSeek()
+						refresh = threading.Thread(target=self._fetch, args=(key, pending))
+						refresh.setDaemon(True)
+						refresh.start()
+					return results
+				
+				self._remove(key)
+			
+			pending = self._pending.get(key)
+			owner = pending == None
+			if owner:
+				pending = self._pending[key] = _PendingSeek()
+		finally:
+			self._lock.release()
+		
+		if owner:
+			self._fetch(key, pending)
+		else:
+			pending.done.wait()
+		
+		if pending.error != None:
+			raise pending.error
+		return pending.results
+	
+	def invalidate(self, stype='', aname='', sname=''):
+		""" Forgets the results for a query """
+		self._lock.acquire()
+		try:
+			self._remove((aname, stype, sname))
+		finally:
+			self._lock.release()
+	
+	def clear(self):
+		self._lock.acquire()
+		try:
+			self._entries.clear()
+		finally:
+			self._lock.release()
+	
+	def __len__(self):
+		return len(self._entries)
+	
+	def _create_seeker(self, stype, aname, sname):
+		return Seeker(stype, aname, sname, timeout=self.timeout)
+	
+	def _fetch(self, key, pending):
+		try:
+			aname,stype,sname = key
+			pending.results = frozenset(self.seeker_factory(stype, aname, sname).run())
+		except Exception as e:
+			pending.error = e
+		
+		self._lock.acquire()
+		try:
+			if pending.error == None:
+				self._remove(key)
+				self._entries[key] = (pending.results, time.time())
+				while len(self._entries) > self.max_entries:
+					self._entries.popitem(last=False)
+			del self._pending[key]
+		finally:
+			self._lock.release()
+		
+		pending.done.set()
+	
+	def _touch(self, key):
+		self._entries[key] = self._entries.pop(key)
+	
+	def _remove(self, key):
+		self._entries.pop(key, None)
+
+class _PendingSeek(object):
+	def __init__(self):
+		self.done = threading.Event()
+		self.results = None
+		self.error = None
 
 def _send_packet(sock, to, opcode, data):
 	sock.sendto(_MAGIC + opcode + data, 0, to)
 
+def _parse_header(rawdata):
+	""" Returns the opcode of rawdata, or None if this isn't a -conf packet.
+	The minusconf-data starts at _HEADER_SIZE; unlike _parse_packet, this does not copy it. """
+	
+	if len(rawdata) < _HEADER_SIZE or not rawdata.startswith(_MAGIC):
+		# Wrong protocol
+		return None
+	
+	return rawdata[len(_MAGIC):_HEADER_SIZE]
+
+def _packet_opcode(rawdata):
+	""" Returns the opcode of rawdata in either encoding, or None if this isn't a -conf packet """
+	
+	opcode = _parse_header(rawdata)
+	if opcode == _OPCODE_V2:
+		return rawdata[_HEADER_SIZE:_HEADER_SIZE_V2] or None
+	return opcode
+
+def _is_v2(rawdata):
+	return rawdata[len(_MAGIC):_HEADER_SIZE] == _OPCODE_V2
+
 def _parse_packet(rawdata):
 	""" Returns a tupel (opcode, minusconf-data). opcode is None if this isn't a -conf packet."""
 	
-	if (len(rawdata) < len(_MAGIC) + 1) or (_MAGIC != rawdata[:len(_MAGIC)]):
-		# Wrong protocol
+	opcode = _parse_header(rawdata)
+	if opcode == None:
 		return (None, None)
 	
-	opcode = rawdata[len(_MAGIC):len(_MAGIC)+1]
-	payload = rawdata[len(_MAGIC)+1:]
+	return (opcode, rawdata[_HEADER_SIZE:])
+
+def _recv_exactly(sock, size):
+	""" Returns size bytes from the stream sock, or None if it ends before """
 	
-	return (opcode, payload)
+	res = []
+	while size > 0:
+		data = sock.recv(size)
+		if not data:
+			return None
+		res.append(data)
+		size -= len(data)
+	return _compat_bytes('').join(res)
+
+def _recv_frame(sock):
+	""" Returns the data of the next frame of a bulk transfer, or None if the stream ends before """
+	
+	header = _recv_exactly(sock, _FRAME_HEADER.size)
+	if header == None:
+		return None
+	return _recv_exactly(sock, _FRAME_HEADER.unpack(header)[0])
 
 def _check_val(val):
 	""" Checks whether a minusconf value contains any NUL bytes. """
@@ -488,17 +2431,229 @@ def _decode_string(buf, pos):
 	""" Decodes a string in the buffer buf, starting at position pos.
 	Returns a tupel of the read string and the next byte to read.
 	"""
-	for i in range(pos, len(buf)):
-		if buf[i:i+1] == _compat_bytes('\x00'):
-			try:
-				return (buf[pos:i].decode(_CHARSET), i+1)
-			# Uncomment the following two lines for detailled information
-			#except UnicodeDecodeError as ude:
-			#	raise MinusconfError(str(ude))
-			except UnicodeDecodeError:
-				raise MinusconfError('Not a valid ' + _CHARSET + ' string: ' + repr(buf[pos:i]))
+	strs,pos = _decode_strings(buf, pos, 1)
+	return (strs[0], pos)
+
+def _decode_strings(buf, pos, count):
+	""" Decodes count (at least 1) consecutive strings in the buffer buf, starting at position pos.
+	Returns a tupel of the list of read strings and the next byte to read.
+	
+	The terminators are located with bytes.find, and all strings are decoded and split in one go.
+	Since UTF-8 never contains a NUL byte except for the encoded U+0000, this is equivalent to decoding them one by one.
+	"""
+	
+	end = pos - 1
+	for _ in range(count):
+		end = buf.find(_STRING_TERMINATOR, end + 1)
+		if end < 0:
+			raise MinusconfError("Premature end of string (Forgot trailing \\0?), buf=" + repr(buf))
+	
+	try:
+		return (buf[pos:end].decode(_CHARSET).split('\x00'), end + 1)
+	except UnicodeDecodeError:
+		pass
+	
+	# Find the culprit for the error message
+	for _ in range(count):
+		end = buf.find(_STRING_TERMINATOR, pos)
+		try:
+			buf[pos:end].decode(_CHARSET)
+		# Uncomment the following two lines for detailled information
+		#except UnicodeDecodeError as ude:
+		#	raise MinusconfError(str(ude))
+		except UnicodeDecodeError:
+			raise MinusconfError('Not a valid ' + _CHARSET + ' string: ' + repr(buf[pos:end]))
+		pos = end + 1
+
+def _encode_varint(n):
+	""" Encodes a non-negative integer in groups of 7 bits, least significant first. The high bit is set in all bytes but the last. """
+	
+	res = bytearray()
+	while n >= 0x80:
+		res.append((n & 0x7f) | 0x80)
+		n >>= 7
+	res.append(n)
+	return _compat_bytes(res)
+
+def _decode_varint(data, pos):
+	""" Decodes an integer encoded with _encode_varint in the bytearray data, starting at position pos.
+	Returns a tupel of the integer and the next byte to read.
+	"""
+	
+	res = 0
+	shift = 0
+	while True:
+		if pos >= len(data):
+			raise MinusconfError('Premature end of length, buf=' + repr(data))
+		b = data[pos]
+		pos += 1
+		res |= (b & 0x7f) << shift
+		if b < 0x80:
+			return (res, pos)
+		shift += 7
+
+def _encode_field(val):
+	""" Encodes a string in the v2 encoding: its length in bytes as a varint, followed by the UTF-8 bytes """
+	
+	data = val.encode(_CHARSET)
+	return _encode_varint(len(data)) + data
+
+def _encode_fields(vals):
+	""" Encodes the payload of a v2 packet: the number of fields, followed by the fields """
+	return _encode_varint(len(vals)) + _compat_bytes('').join(_encode_field(val) for val in vals)
+
+def _split_fields(buf, pos):
+	""" Locates the fields of a v2 packet in buf, whose field count starts at position pos.
+	Returns a tupel of the list of (start, end) positions of the encoded fields and the next byte to read.
+	
+	Nothing is decoded yet; since every field is prefixed with its length, this only hops from one length to the next.
+	"""
+	
+	data = bytearray(buf)
+	count,pos = _decode_varint(data, pos)
+	if count > len(data) - pos: # Every field takes at least one byte
+		raise MinusconfError('Packet too short for ' + str(count) + ' fields, buf=' + repr(buf))
+	
+	res = []
+	try:
+		for _ in range(count):
+			length = data[pos]
+			if length < 0x80:
+				pos += 1
+			else:
+				length,pos = _decode_varint(data, pos)
+			res.append((pos, pos + length))
+			pos += length
+	except IndexError:
+		pos = len(data) + 1
+	
+	if pos > len(data):
+		raise MinusconfError('Premature end of field, buf=' + repr(buf))
+	return (res, pos)
+
+def _decode_fields(buf, bounds):
+	""" Decodes the fields at the positions bounds (as returned by _split_fields) of buf. Returns the list of strings.
+	
+	If all fields are ASCII, the length prefixes are too, and everything is decoded in one go and sliced.
+	"""
 	
-	raise MinusconfError("Premature end of string (Forgot trailing \\0?), buf=" + repr(buf))
+	if not bounds:
+		return []
+	
+	start = bounds[0][0]
+	data = buf[start:bounds[-1][1]]
+	try:
+		text = data.decode(_CHARSET)
+		if len(text) == len(data): # Character positions are byte positions
+			return [text[s-start:e-start] for s,e in bounds]
+	except UnicodeDecodeError:
+		pass
+	
+	res = []
+	for s,e in bounds:
+		try:
+			res.append(buf[s:e].decode(_CHARSET))
+		except UnicodeDecodeError:
+			raise MinusconfError('Not a valid ' + _CHARSET + ' string: ' + repr(buf[s:e]))
+	return res
+
+def _decode_payload(rawdata, count):
+	""" Decodes the first count fields of a packet in either encoding.
+	Returns a tupel of the list of read strings and the next byte to read, after all fields of a v2 packet.
+	"""
+	
+	if not _is_v2(rawdata):
+		return _decode_strings(rawdata, _HEADER_SIZE, count)
+	
+	bounds,pos = _split_fields(rawdata, _HEADER_SIZE_V2)
+	if len(bounds) < count:
+		raise MinusconfError('Expected ' + str(count) + ' fields, got ' + str(len(bounds)))
+	return (_decode_fields(rawdata, bounds[:count]), pos)
+
+def _send_fields(sock, to, opcode, vals, v2=False):
+	""" Sends a packet consisting of the strings vals, in the v2 encoding if v2 is set """
+	
+	if v2:
+		sock.sendto(_MAGIC + _OPCODE_V2 + opcode + _encode_fields(vals), 0, to)
+	else:
+		_send_packet(sock, to, opcode, _compat_bytes('').join(_encode_string(val) for val in vals))
+
+def _digest(payload):
+	""" Returns the digest of an advertisement payload (the encoded strings), as used for known answers.
+	hashlib is only imported on first use. """
+	global _digest
+	import hashlib
+	
+	def _digest(payload):
+		return hashlib.sha1(payload).digest()[:_DIGEST_SIZE]
+	
+	return _digest(payload)
+
+def _split_digests(data):
+	""" Returns the set of the digests in a known answers extension """
+	
+	if not data:
+		return frozenset()
+	
+	return frozenset(data[i:i+_DIGEST_SIZE] for i in range(0, len(data) - _DIGEST_SIZE + 1, _DIGEST_SIZE))
+
+def _encode_extension(etype, data):
+	return _EXTENSION_HEADER.pack(etype, len(data)) + data
+
+def _decode_extensions(buf, pos):
+	""" Decodes the extensions after the fields of a query, starting at position pos.
+	Returns a dictionary type -> data. Since old implementations ignore trailing data,
+	malformed extensions are ignored altogether instead of rejecting the packet.
+	"""
+	
+	res = {}
+	hsize = _EXTENSION_HEADER.size
+	while pos + hsize <= len(buf):
+		etype,length = _EXTENSION_HEADER.unpack_from(buf, pos)
+		pos += hsize
+		if pos + length > len(buf):
+			return {}
+		res[etype] = buf[pos:pos+length]
+		pos += length
+	
+	return res
+
+def _decode_records(rawdata):
+	""" Yields the services in an aggregated advertisement, announcement or goodbye as tupels
+	(aname, stype, sname, location, port, payload), payload being the encoded fields the digest is computed from.
+	Packets in the v2 encoding are accepted as well; their payloads are converted to the v1 encoding. """
+	
+	if _is_v2(rawdata):
+		for record in _decode_records_v2(rawdata):
+			yield record
+		return
+	
+	aname,pos = _decode_string(rawdata, _HEADER_SIZE)
+	encoded_aname = rawdata[_HEADER_SIZE:pos]
+	
+	while pos < len(rawdata):
+		(stype, sname, location, port),p = _decode_strings(rawdata, pos, 4)
+		yield (aname, stype, sname, location, port, encoded_aname + rawdata[pos:p])
+		pos = p
+
+def _decode_records_v2(rawdata):
+	""" Returns the services in a packet in the v2 encoding like _decode_records.
+	Since the field count is known up front, a truncated packet is rejected before anything is decoded. """
+	
+	bounds,pos = _split_fields(rawdata, _HEADER_SIZE_V2)
+	if len(bounds) % 4 != 1:
+		raise MinusconfError('Expected the advertiser name and 4 fields per service, got ' + str(len(bounds)) + ' fields')
+	
+	fields = _decode_fields(rawdata, bounds)
+	encoded = [rawdata[s:e] for s,e in bounds]
+	aname = fields[0]
+	encoded_aname = encoded[0] + _STRING_TERMINATOR
+	
+	res = []
+	for i in range(1, len(fields), 4):
+		payload = encoded_aname + _STRING_TERMINATOR.join(encoded[i:i+4]) + _STRING_TERMINATOR
+		res.append((aname, fields[i], fields[i+1], fields[i+2], fields[i+3], payload))
+	return res
 
 def _string_match(query, value):
 	return query == "" or query == value
@@ -522,6 +2677,17 @@ def _multicast_join_group(sock, family, addr):
 	else:
 		raise ValueError('Unsupported protocol family ' + family)
 
+def _multicast_leave_group(sock, family, addr):
+	group_bin = _inet_pton(family, addr)
+	if family == socket.AF_INET: # IPv4
+		mreq = group_bin + struct.pack('=I', socket.INADDR_ANY)
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+	elif family == socket.AF_INET6: # IPv6
+		mreq = group_bin + struct.pack('@I', 0)
+		sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_LEAVE_GROUP, mreq)
+	else:
+		raise ValueError('Unsupported protocol family ' + family)
+
 def _resolve_addrs(straddrs, port, ignore_unavailable=False, protocols=[socket.AF_INET, socket.AF_INET6]):
 	""" Returns a tupel of tupels of (family, to, original_addr_family, original_addr).
 	
@@ -548,6 +2714,262 @@ def _resolve_addrs(straddrs, port, ignore_unavailable=False, protocols=[socket.A
 	
 	return res
 
+class _BatchedSocket(object):
+	""" Wraps a UDP socket to receive and send datagrams in batches with recvmmsg/sendmmsg (Linux only).
+	Packets are received into a preallocated buffer ring. Replies to the senders of the current batch are copied
+	into a second ring and sent with a single system call by flush(); anything else is passed on to the socket.
+	The ctypes structures are accessed through memoryviews, which is much cheaper than attribute access.
+	"""
+	
+	@classmethod
+	def create(cls, sock, size):
+		""" Returns a _BatchedSocket, or None if batched I/O is not available """
+		
+		if _load_mmsg() == None:
+			return None
+		return cls(sock, size)
+	
+	def __init__(self, sock, size):
+		ct = _mmsg.ctypes
+		
+		self._sock = sock
+		self.size = size
+		self._fd = sock.fileno()
+		
+		self._recv_bufs = ct.create_string_buffer(size * _MAX_PACKET_SIZE)
+		self._send_bufs = ct.create_string_buffer(size * _MAX_PACKET_SIZE)
+		self._names = (_mmsg.sockaddr_storage * size)()
+		self._recv_iovs = (_mmsg.iovec * size)()
+		self._recv_msgs = (_mmsg.mmsghdr * size)()
+		self._send_iovs = (_mmsg.iovec * size)()
+		self._send_msgs = (_mmsg.mmsghdr * size)()
+		for i in range(size):
+			self._recv_iovs[i].iov_base = ct.addressof(self._recv_bufs) + i * _MAX_PACKET_SIZE
+			self._recv_iovs[i].iov_len = _MAX_PACKET_SIZE
+			self._recv_msgs[i].msg_hdr.msg_name = ct.addressof(self._names[i])
+			self._recv_msgs[i].msg_hdr.msg_namelen = ct.sizeof(_mmsg.sockaddr_storage)
+			self._recv_msgs[i].msg_hdr.msg_iov = ct.pointer(self._recv_iovs[i])
+			self._recv_msgs[i].msg_hdr.msg_iovlen = 1
+			self._send_iovs[i].iov_base = ct.addressof(self._send_bufs) + i * _MAX_PACKET_SIZE
+			self._send_msgs[i].msg_hdr.msg_iov = ct.pointer(self._send_iovs[i])
+			self._send_msgs[i].msg_hdr.msg_iovlen = 1
+		
+		self._recv_bufs_view = memoryview(self._recv_bufs).cast('B')
+		self._send_bufs_view = memoryview(self._send_bufs).cast('B')
+		self._names_view = memoryview(self._names).cast('B')
+		self._recv_msgs_view = memoryview(self._recv_msgs).cast('B')
+		self._send_iovs_view = memoryview(self._send_iovs).cast('B')
+		self._send_msgs_view = memoryview(self._send_msgs).cast('B')
+		self._name_addrs = [ct.addressof(self._names[i]) for i in range(size)]
+		self._namelens = [0] * size
+		
+		self._senders = {}
+		self._sender_cache = {}
+		self._replies = 0
+	
+	def __getattr__(self, name):
+		return getattr(self._sock, name)
+	
+	def recv_batch(self):
+		""" Blocks until at least one packet arrives (or the socket's timeout expires).
+		Returns a list of up to size (rawdata, sender) tupels. """
+		
+		if self._replies > 0:
+			self.flush()
+		
+		if self._sock.gettimeout() == None:
+			flags = _mmsg.MSG_WAITFORONE
+		else: # Non-blocking socket
+			if not select.select([self._sock], [], [], self._sock.gettimeout())[0]:
+				raise socket.timeout('timed out')
+			flags = socket.MSG_DONTWAIT
+		
+		while True:
+			count = _mmsg.libc.recvmmsg(self._fd, self._recv_msgs, self.size, flags, None)
+			if count >= 0:
+				break
+			err = _mmsg.ctypes.get_errno()
+			if err != errno.EINTR:
+				raise socket.error(err, os.strerror(err))
+		
+		msgs = self._recv_msgs_view
+		bufs = self._recv_bufs_view
+		names = self._names_view
+		namelens = self._namelens
+		msgsize = _mmsg.mmsghdr_size
+		namesize = _mmsg.sockaddr_storage_size
+		namelen_off = _mmsg.msg_namelen_offset
+		len_off = _mmsg.msg_len_offset
+		unpack_uint = _mmsg.uint.unpack_from
+		pack_uint = _mmsg.uint.pack_into
+		cache = self._sender_cache
+		if len(cache) > 4 * self.size:
+			cache.clear()
+		
+		self._senders = senders = {}
+		res = []
+		for i in range(count):
+			namelen = unpack_uint(msgs, i * msgsize + namelen_off)[0]
+			pack_uint(msgs, i * msgsize + namelen_off, namesize)
+			namelens[i] = namelen
+			rawname = names[i * namesize:i * namesize + namelen].tobytes()
+			sender = cache.get(rawname)
+			if sender == None:
+				sender = cache[rawname] = _mmsg.decode_sockaddr(rawname)
+			senders[id(sender)] = (sender, i) # Identical senders map to the same (identical) name
+			
+			start = i * _MAX_PACKET_SIZE
+			res.append((bufs[start:start + unpack_uint(msgs, i * msgsize + len_off)[0]].tobytes(), sender))
+		
+		return res
+	
+	def sendto(self, data, flags, to):
+		entry = self._senders.get(id(to))
+		if entry == None or entry[0] is not to or flags != 0 or len(data) > _MAX_PACKET_SIZE:
+			return self._sock.sendto(data, flags, to)
+		
+		if self._replies >= self.size:
+			self.flush()
+		
+		i = self._replies
+		idx = entry[1]
+		self._send_bufs_view[i * _MAX_PACKET_SIZE:i * _MAX_PACKET_SIZE + len(data)] = data
+		_mmsg.size_t.pack_into(self._send_iovs_view, i * _mmsg.iovec_size + _mmsg.iov_len_offset, len(data))
+		_mmsg.name.pack_into(self._send_msgs_view, i * _mmsg.mmsghdr_size, self._name_addrs[idx], self._namelens[idx])
+		self._replies = i + 1
+		
+		return len(data)
+	
+	def flush(self):
+		""" Sends all queued replies """
+		
+		count,self._replies = self._replies,0
+		
+		pos = 0
+		while pos < count:
+			sent = _mmsg.libc.sendmmsg(self._fd, _mmsg.ctypes.byref(self._send_msgs, pos * _mmsg.mmsghdr_size), count - pos, 0)
+			if sent < 0:
+				if _mmsg.ctypes.get_errno() == errno.EINTR:
+					continue
+				sent = 1 # Skip the reply that failed, as if it had been lost
+			pos += sent
+
+_mmsg = None
+def _load_mmsg():
+	""" Loads the ctypes definitions for recvmmsg/sendmmsg on first use. Returns None if they are not available. """
+	
+	global _mmsg
+	if _mmsg != None:
+		return _mmsg or None
+	
+	_mmsg = False
+	try:
+		import ctypes
+		import ctypes.util
+		
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		libc.recvmmsg
+		libc.sendmmsg
+	except (ImportError, OSError, AttributeError, TypeError):
+		return None
+	
+	class iovec(ctypes.Structure):
+		_fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+	
+	class msghdr(ctypes.Structure):
+		_fields_ = [
+			('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+			('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+			('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+			('msg_flags', ctypes.c_int)]
+	
+	class mmsghdr(ctypes.Structure):
+		_fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+	
+	class sockaddr_storage(ctypes.Structure):
+		_fields_ = [('ss_family', ctypes.c_ushort), ('ss_data', ctypes.c_char * 126)]
+	
+	def decode_sockaddr(raw):
+		if struct.unpack('=H', raw[:2])[0] == socket.AF_INET6:
+			port,flowinfo = struct.unpack('!HI', raw[2:8])
+			return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, struct.unpack('=I', raw[24:28])[0])
+		return (socket.inet_ntop(socket.AF_INET, raw[4:8]), struct.unpack('!H', raw[2:4])[0])
+	
+	libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+	libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+	
+	class _MmsgDefinitions(object):
+		pass
+	
+	_mmsg = _MmsgDefinitions()
+	_mmsg.ctypes = ctypes
+	_mmsg.libc = libc
+	_mmsg.iovec = iovec
+	_mmsg.mmsghdr = mmsghdr
+	_mmsg.sockaddr_storage = sockaddr_storage
+	_mmsg.decode_sockaddr = decode_sockaddr
+	_mmsg.MSG_WAITFORONE = 0x10000
+	
+	# Layout, for direct access through memoryviews
+	_mmsg.mmsghdr_size = ctypes.sizeof(mmsghdr)
+	_mmsg.iovec_size = ctypes.sizeof(iovec)
+	_mmsg.sockaddr_storage_size = ctypes.sizeof(sockaddr_storage)
+	_mmsg.msg_namelen_offset = mmsghdr.msg_hdr.offset + msghdr.msg_namelen.offset
+	_mmsg.msg_len_offset = mmsghdr.msg_len.offset
+	_mmsg.iov_len_offset = iovec.iov_len.offset
+	_mmsg.uint = struct.Struct('=I')
+	_mmsg.size_t = struct.Struct('=' + {4: 'I', 8: 'Q'}[ctypes.sizeof(ctypes.c_size_t)])
+	_mmsg.name = struct.Struct('=' + {4: 'I', 8: 'Q'}[ctypes.sizeof(ctypes.c_void_p)] + 'I') # msg_name, msg_namelen
+	assert msghdr.msg_name.offset == 0 and msghdr.msg_namelen.offset == ctypes.sizeof(ctypes.c_void_p)
+	
+	return _mmsg
+
+def _listen_socks(addresses, port, family):
+	""" Returns a list of sockets of family receiving what is sent to the multicast groups in addresses on port.
+	They are bound to the group addresses, so that they do not receive unicast packets to port.
+	(As with the other sockets, IPv4 packets arriving at an IPv6 socket have IPv4-mapped sender addresses.) """
+	
+	res = []
+	for fam,to,orig_fam,orig_addr in _resolve_addrs(addresses, port, True, [family]):
+		sock = socket.socket(fam, socket.SOCK_DGRAM)
+		try:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, struct.pack('@I', 1))
+			sock.bind(to)
+			_multicast_join_group(sock, orig_fam, orig_addr)
+		except socket.error: # For example Windows, which does not allow binding to a multicast address
+			sock.close()
+			continue
+		res.append(sock)
+	
+	return res
+
+def _reuse_port(sock):
+	""" Lets sock share its port with other sockets that do the same; the kernel distributes unicast packets among them.
+	The socket does not receive multicast packets, except for groups it joins itself (Linux only). """
+	
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, struct.pack('@I', 1))
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, struct.pack('@I', 1))
+	
+	sock.setsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MULTICAST_ALL', 49), struct.pack('@I', 0))
+	if sock.family == socket.AF_INET6:
+		try:
+			sock.setsockopt(socket.IPPROTO_IPV6, getattr(socket, 'IPV6_MULTICAST_ALL', 29), struct.pack('@I', 0))
+		except socket.error: # Linux < 4.20: IPv6 multicast packets may also arrive here
+			pass
+
+def _wakeup_socks():
+	""" Returns two connected sockets; sending to the second one makes the first one readable """
+	
+	if hasattr(socket, 'socketpair'):
+		return socket.socketpair()
+	
+	# Windows before Python 3.5
+	res = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	res.bind(('127.0.0.1', 0))
+	sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sender.connect(res.getsockname())
+	return (res, sender)
+
 def _find_sock():
 	""" Create a UDP socket """
 	if socket.has_ipv6:
@@ -579,14 +3001,31 @@ def _main():
 		advertiser = Advertiser([service], advertisername)
 		advertiser.run()
 	elif sc == 's' or sc == 'seek':
-		if len(options) > 4:
+		import getopt
+		try:
+			opts,options = getopt.getopt(options, '1n:q:t:', ['first', 'count=', 'quiet=', 'timeout='])
+		except getopt.GetoptError as ge:
+			_usage(str(ge))
+		if len(options) > 3:
 			_usage()
 		
-		aname = options[0] if len(options) > 0 else ''
-		stype = options[1] if len(options) > 1 else ''
+		stype = options[0] if len(options) > 0 else ''
+		aname = options[1] if len(options) > 1 else ''
 		sname = options[2] if len(options) > 2 else ''
 		
-		se = Seeker(aname, stype, sname, find_callback=_print_result, error_callback=_print_error)
+		se = Seeker(stype, aname, sname, find_callback=_print_result, error_callback=_print_error)
+		try:
+			for opt,val in opts:
+				if opt in ('-1', '--first'):
+					se.max_results = 1
+				elif opt in ('-n', '--count'):
+					se.max_results = int(val)
+				elif opt in ('-q', '--quiet'):
+					se.idle_timeout = float(val)
+				elif opt in ('-t', '--timeout'):
+					se.timeout = float(val)
+		except ValueError:
+			_usage('Invalid value for ' + opt + ': ' + repr(val))
 		se.run()
 	else:
 		_usage('Unknown subcommand "' + sys.argv[0] + '"')
@@ -606,11 +3045,12 @@ def _usage(note=None, and_exit=True):
 	
 	print("Usage: " + sys.argv[0] + " subcommand options...")
 	print("\ta[dvertise] servicetype port [advertisername [servicename [location]]]")
-	print("\ts[eek]      [servicetype [advertisername [servicename]]]")
+	print("\ts[eek]      [-1|--first] [-n|--count N] [-q|--quiet S] [-t|--timeout S] [servicetype [advertisername [servicename]]]")
 	print('Use "" for default/any value.')
 	print("Examples:")
 	print("\t" + sys.argv[0] + " advertise http 80 fastmachine Apache")
 	print("\t" + sys.argv[0] + ' seek http "" Apache')
+	print("\t" + sys.argv[0] + ' seek --first --quiet 0.2 http')
 	
 	if and_exit:
 		sys.exit(0)
@@ -678,30 +3118,40 @@ def _compat_inet_pton(family, addr):
 			res = struct.pack('!H', intval) + res
 		
 		return res
-		
+	
 	else:
 		raise ValueError("Unknown protocol family " + family)
 
-# Cover for socket_pton inavailability on some systems (non-IPv6 or Windows)
-try:
-	import ipaddr
-	
-	if hasattr(ipaddr.IPv4, 'packed'):
-		def _inet_pton(family, addr):
-			if family == socket.AF_INET:
-				return ipaddr.IPv4(addr).packed
-			elif family == socket.AF_INET6:
-				return ipaddr.IPv6(addr).packed
-			else:
-				raise ValueError("Unknown protocol family " + family)
-except:
-	pass
-
-if not '_inet_pton' in dir():
+def _inet_pton(family, addr):
+	""" socket.inet_pton, covering for its inavailability on some systems (non-IPv6 or Windows).
+	The implementation is chosen on first use. """
+	global _inet_pton
+	
 	if hasattr(socket, 'inet_pton'):
 		_inet_pton = socket.inet_pton
 	else:
 		_inet_pton = _compat_inet_pton
+		try:
+			import ipaddr
+			
+			if hasattr(ipaddr.IPv4, 'packed'):
+				def _ipaddr_inet_pton(family, addr):
+					if family == socket.AF_INET:
+						return ipaddr.IPv4(addr).packed
+					elif family == socket.AF_INET6:
+						return ipaddr.IPv6(addr).packed
+					else:
+						raise ValueError("Unknown protocol family " + family)
+				_inet_pton = _ipaddr_inet_pton
+		except ImportError:
+			pass
+	
+	return _inet_pton(family, addr)
+
+if sys.version_info < (3, 7): # No module __getattr__
+	for _loader in set(_LAZY_LOADERS.values()):
+		_loader()
+		_lazy_loaded.add(_loader)
 
 if __name__ == '__main__':
 	_main()
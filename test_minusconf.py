@@ -4,6 +4,8 @@
 import unittest
 import minusconf
 import socket
+import subprocess
+import sys
 import time
 import os
 
@@ -42,6 +44,121 @@ class MinusconfUnitTest(unittest.TestCase):
 		
 		assert_sm('', '', [self.svc1, self.svc2, self.svc3])
 	
+	def testCatalogCache(self):
+		_cb = minusconf._compat_bytes
+		a = minusconf.Advertiser([self.svc1], 'minusconf.test.catalog.' + self._testid)
+		a._sock = self._create_fake_sock()
+		
+		def query(aname, stype, sname):
+			a._sock.sent = []
+			qry = minusconf._encode_string(aname) + minusconf._encode_string(stype) + minusconf._encode_string(sname)
+			a._handle_packet(minusconf._MAGIC + minusconf._OPCODE_QUERY + qry, '::')
+			return a._sock.sent
+		
+		sent = query('', '', '')
+		self.assertEquals(len(sent), 1)
+		self.assertEquals(sent[0][0], minusconf._MAGIC + minusconf._OPCODE_ADVERTISEMENT +
+			minusconf._encode_string(a.aname) + minusconf._encode_string(self.svc1.stype) +
+			minusconf._encode_string(self.svc1.sname) + minusconf._encode_string(self.svc1.location) +
+			minusconf._encode_string(self.svc1.port))
+		catalog = a._get_catalog()
+		self.assertTrue(a._get_catalog() is catalog)
+		
+		# In-place modifications
+		a.services.append(self.svc2)
+		self.assertEquals(len(query('', '', '')), 2)
+		self.assertEquals(len(query('', self.svc2.stype, '')), 1)
+		self.assertEquals(len(query('', '', self.svc2.sname)), 1)
+		self.assertEquals(len(query('', self.svc2.stype, self.svc1.sname)), 0)
+		a.services += [self.svc3]
+		self.assertEquals(len(query('', self.svc2.stype, '')), 2)
+		del a.services[0]
+		self.assertEquals(len(query('', self.svc1.stype, '')), 0)
+		
+		# Reassignments
+		a.services = [self.svc4]
+		self.assertEquals(len(query('', '', '')), 1)
+		self.assertEquals(len(query(a.aname, '', '')), 1)
+		a.aname = 'minusconf.test.catalog.renamed.' + self._testid
+		self.assertEquals(len(query('minusconf.test.catalog.' + self._testid, '', '')), 0)
+		self.assertTrue(query(a.aname, '', '')[0][0].find(minusconf._encode_string(a.aname)) >= 0)
+	
+	def testQueryFilter(self):
+		_cb = minusconf._compat_bytes
+		qf = minusconf.QueryFilter(rate=10, burst=3, dedupe_window=0.01, max_entries=100)
+		
+		# Duplicates, also across address families
+		self.assertTrue(qf.allow(_cb('q1'), ('10.0.0.1', 1000), 100.0))
+		self.assertFalse(qf.allow(_cb('q1'), ('::ffff:10.0.0.1', 1000, 0, 0), 100.001))
+		self.assertTrue(qf.allow(_cb('q1'), ('10.0.0.2', 1000), 100.001))
+		self.assertTrue(qf.allow(_cb('q2'), ('10.0.0.1', 1000), 100.002))
+		self.assertTrue(qf.allow(_cb('q1'), ('10.0.0.1', 1000), 100.02))
+		
+		# Rate limit: the burst is used up, then one packet every 0.1s
+		self.assertFalse(qf.allow(_cb('q3'), ('10.0.0.1', 1000), 100.03))
+		self.assertTrue(qf.allow(_cb('q4'), ('10.0.0.1', 1000), 100.15))
+		self.assertFalse(qf.allow(_cb('q5'), ('10.0.0.1', 1000), 100.16))
+		self.assertTrue(qf.allow(_cb('q6'), ('10.0.0.2', 1000), 100.16))
+		self.assertEquals(qf.dropped, 3)
+		
+		# Bounded memory
+		for i in range(1000):
+			qf.allow(_cb('q' + str(i)), ('10.1.' + str(i // 256) + '.' + str(i % 256), 1000), 200.0)
+		self.assertTrue(len(qf._buckets) <= 100)
+		self.assertTrue(len(qf._recent) <= 100)
+		
+		# In an advertiser
+		a = minusconf.Advertiser([self.svc1], 'minusconf.test.queryfilter.' + self._testid)
+		a._sock = self._create_fake_sock()
+		a.query_filter = minusconf.QueryFilter(rate=None)
+		qry = minusconf._MAGIC + minusconf._OPCODE_QUERY + _cb('\0\0\0')
+		a._handle_packet(qry, ('::ffff:10.0.0.1', 1000, 0, 0))
+		a._handle_packet(qry, ('10.0.0.1', 1000))
+		self.assertEquals(len(a._sock.sent), 1)
+	
+	def testMetrics(self):
+		_cb = minusconf._compat_bytes
+		a = minusconf.Advertiser([self.svc1, self.svc2], 'minusconf.test.metrics.' + self._testid)
+		a._sock = self._create_fake_sock()
+		a.metrics = minusconf.Metrics({'role': 'advertiser'})
+		s = minusconf.Seeker(self.svc1.stype)
+		s._init_seeker()
+		s._sock.close()
+		s._sock = self._create_fake_sock()
+		s.metrics = a.metrics
+		
+		s._send_query(('::1', minusconf._PORT))
+		a._handle_packet(s._sock.sent[0][0], ('::1', 1234))
+		for packet,to in a._sock.sent:
+			s._handle_packet(packet, ('::1', 1234))
+		a._handle_packet(_cb('junk'), ('::1', 1234))
+		a._handle_packet(minusconf._MAGIC + minusconf._OPCODE_QUERY + _cb('\0'), ('::1', 1234))
+		s._handle_packet(_cb('junk'), ('::1', 1234))
+		
+		snapshot = a.metrics.snapshot()
+		self.assertEquals(snapshot['counters'], {
+			'queries_sent': 1, 'packets_received': 5, 'queries_received': 1, 'queries_answered': 1, 'replies_sent': 1,
+			'advertisements_received': 1, 'results_found': 1, 'packets_rejected': 2, 'packets_malformed': 1})
+		packet_seconds = snapshot['histograms']['packet_seconds']
+		self.assertEquals(packet_seconds['count'], 5)
+		self.assertEquals(packet_seconds['buckets'][-1], (float('inf'), 5))
+		
+		text = a.metrics.prometheus_text()
+		self.assertTrue('# TYPE minusconf_queries_answered_total counter\nminusconf_queries_answered_total{role="advertiser"} 1\n' in text)
+		self.assertTrue('minusconf_packet_seconds_bucket{le="+Inf",role="advertiser"} 5\n' in text)
+		self.assertTrue('minusconf_packet_seconds_count{role="advertiser"} 5\n' in text)
+		
+		left,right = socket.socketpair()
+		try:
+			a.metrics.write_prometheus(left)
+			self.assertEquals(right.recv(65536), text.encode('utf-8'))
+		finally:
+			left.close()
+			right.close()
+		
+		# Disabled by default
+		self.assertFalse(minusconf.Advertiser().metrics.enabled)
+	
 	def testServiceRepresentation(self):
 		svca = minusconf.ServiceAt('aaa', 'bbb', 'ccc', 'ddd', 'eee', 'fff')
 		
@@ -65,10 +182,86 @@ class MinusconfUnitTest(unittest.TestCase):
 			self.assertTrue(r.find(reprfunc(svca.aname)) >= 0)
 			self.assertTrue(r.find(reprfunc(svca.location)) >= 0)
 	
+	def testImmutableStructs(self):
+		import pickle
+		svca = minusconf.ServiceAt('aaa', 'bbb', 'ccc', 'ddd', 'eee', 'fff')
+		same = minusconf.ServiceAt('aaa', 'bbb', 'ccc', 'ddd', 'eee', 'fff')
+		other = minusconf.ServiceAt('aaa', 'bbb', 'ccc', 'ddd', 'eee', 'ggg')
+		
+		self.assertRaises(TypeError, setattr, svca, 'aname', 'x')
+		self.assertRaises(TypeError, setattr, svca, 'newattr', 'x')
+		self.assertRaises(TypeError, delattr, svca, 'aname')
+		self.assertFalse(hasattr(svca, '__dict__'))
+		
+		self.assertEquals(svca, same)
+		self.assertEquals(hash(svca), hash(same))
+		self.assertFalse(svca != same)
+		self.assertNotEquals(svca, other)
+		self.assertTrue(svca < other)
+		self.assertNotEquals(svca, 'aaa')
+		self.assertEquals(len(set([svca, same, other])), 2)
+		self.assertEquals(svca.effective_location, 'ddd')
+		self.assertEquals(minusconf.ServiceAt('a', 'b', 'c', '', 'e', 'f').effective_location, 'f')
+		
+		for obj in (svca, self.svc1):
+			copy = pickle.loads(pickle.dumps(obj))
+			self.assertEquals(copy, obj)
+			self.assertEquals(repr(copy), repr(obj))
+		self.assertNotEquals(minusconf.Service('a', 'b', 'c', 'd'), minusconf.ServiceAt('x', 'a', 'c', 'd', 'b', 'y'))
+	
 	def testSingleThreadAdvertiser(self):
 		a_thread = minusconf.ThreadAdvertiser([], 'unittest.advertiser-thread-single')
 		self._runSingleConcurrentAdvertiserTest(a_thread)
 	
+	def testBatchedThreadAdvertiser(self):
+		a_thread = minusconf.ThreadAdvertiser([], 'unittest.advertiser-thread-batched')
+		a_thread.batch_size = 16
+		self._runSingleConcurrentAdvertiserTest(a_thread)
+	
+	def testThreadAdvertiserShutdown(self):
+		for batch_size in (None, 16):
+			a = minusconf.ThreadAdvertiser([self.svc1], 'unittest.advertiser-thread-shutdown')
+			a.batch_size = batch_size
+			a.start_blocking()
+			
+			start = time.time()
+			a.stop_blocking()
+			self.assertTrue(time.time() - start < 1)
+			self.assertFalse(a.is_alive())
+			self.assertEquals(a._groups, [])
+			self.assertRaises(socket.error, a._sock.getsockname)
+			a.stop_blocking()
+	
+	def testBatchedSocket(self):
+		_cb = minusconf._compat_bytes
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			server.bind(('127.0.0.1', 0))
+			client.settimeout(1)
+			bs = minusconf._BatchedSocket.create(server, 4)
+			if bs == None: # No recvmmsg on this platform
+				return
+			
+			for i in range(6):
+				client.sendto(_cb('packet' + str(i)), server.getsockname())
+			
+			packets = bs.recv_batch()
+			self.assertEquals([data for data,sender in packets], [_cb('packet' + str(i)) for i in range(4)])
+			self.assertEquals(packets[0][1], ('127.0.0.1', client.getsockname()[1]))
+			for data,sender in packets:
+				bs.sendto(_cb('re: ') + data, 0, sender)
+			bs.flush()
+			self.assertEquals([data for data,sender in bs.recv_batch()], [_cb('packet4'), _cb('packet5')])
+			
+			self.assertEquals([client.recvfrom(100)[0] for i in range(4)], [_cb('re: packet' + str(i)) for i in range(4)])
+			
+			bs.settimeout(0.01)
+			self.assertRaises(socket.timeout, bs.recv_batch)
+		finally:
+			server.close()
+			client.close()
+	
 	if hasattr(minusconf, 'MultiprocessingAdvertiser'):
 		def testSingleMultiprocessingAdvertiser(self):
 			a_mp = minusconf.MultiprocessingAdvertiser([], 'unittest.advertiser-multiprocessing-single')
@@ -107,6 +300,529 @@ class MinusconfUnitTest(unittest.TestCase):
 			(a2, [self.svc3, self.svc4, self.svc5]),
 			], self.svc2.stype)
 	
+	if hasattr(minusconf, 'AsyncSeeker'):
+		def testAsync(self):
+			import asyncio
+			loop = asyncio.new_event_loop()
+			try:
+				a1 = minusconf.AsyncAdvertiser([self.svc1, self.svc2], 'unittest.async.AsyncAdvertiser1', loop=loop)
+				a2 = minusconf.AsyncAdvertiser([self.svc3], 'unittest.async.AsyncAdvertiser2', loop=loop)
+				loop.run_until_complete(asyncio.gather(a1.start(), a2.start()))
+				
+				seekers = [minusconf.AsyncSeeker(self.svc2.stype, timeout=0.5, loop=loop) for _ in range(5)]
+				results = loop.run_until_complete(asyncio.gather(*[s.seek() for s in seekers]))
+				for res in results:
+					self.assertEquals(set((svca.aname, svca.sname) for svca in res), set([
+						('unittest.async.AsyncAdvertiser1', self.svc2.sname),
+						('unittest.async.AsyncAdvertiser2', self.svc3.sname)]))
+				
+				# async for
+				it = minusconf.AsyncSeeker(self.svc1.stype, timeout=0.5, loop=loop).__aiter__()
+				found = []
+				while True:
+					try:
+						found.append(loop.run_until_complete(it.__anext__()))
+					except StopAsyncIteration:
+						break
+				self.assertEquals(set(svca.sname for svca in found), set([self.svc1.sname]))
+				
+				a1.stop()
+				a2.stop()
+				self.assertEquals(loop.run_until_complete(minusconf.AsyncSeeker(self.svc2.stype, timeout=0.2, loop=loop).seek()), set())
+			finally:
+				loop.close()
+	
+	def testServiceCache(self):
+		import threading
+		calls = []
+		class FakeSeeker(object):
+			def __init__(fself, stype, aname, sname):
+				fself.query = (stype, aname, sname)
+			def run(fself):
+				calls.append(fself.query)
+				time.sleep(0.05)
+				return set([minusconf.ServiceAt(fself.query[1], fself.query[0], fself.query[2], '', str(len(calls)), '::1')])
+		
+		cache = minusconf.ServiceCache(ttl=0.2, max_entries=2, stale_ttl=0.3, seeker_factory=FakeSeeker)
+		
+		# Concurrent callers share a single seek
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(cache.get('stype1'))) for _ in range(5)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEquals(len(calls), 1)
+		self.assertEquals(len(set(results)), 1)
+		self.assertEquals([svca.port for svca in results[0]], ['1'])
+		
+		# Cached
+		self.assertEquals(cache.get('stype1'), results[0])
+		self.assertEquals(len(calls), 1)
+		
+		# Stale: returned immediately, refreshed in the background
+		time.sleep(0.25)
+		self.assertEquals(cache.get('stype1'), results[0])
+		time.sleep(0.15)
+		self.assertEquals(len(calls), 2)
+		self.assertEquals([svca.port for svca in cache.get('stype1')], ['2'])
+		
+		# LRU eviction
+		cache = minusconf.ServiceCache(ttl=10, max_entries=2, seeker_factory=FakeSeeker)
+		cache.get('stype1')
+		cache.get('stype2')
+		cache.get('stype1')
+		cache.get('stype3')
+		self.assertEquals(len(cache), 2)
+		self.assertEquals(len(calls), 5)
+		cache.get('stype1')
+		self.assertEquals(len(calls), 5)
+		cache.get('stype2')
+		self.assertEquals(len(calls), 6)
+		
+		cache.invalidate('stype2')
+		cache.get('stype2')
+		self.assertEquals(len(calls), 7)
+	
+	def testEarlyCompletion(self):
+		a = minusconf.ThreadAdvertiser([self.svc2, self.svc3, self.svc4], 'unittest.earlycompletion.' + self._testid)
+		a.start_blocking()
+		try:
+			def timed_seek(**kwargs):
+				s = minusconf.Seeker(self.svc2.stype, timeout=5, **kwargs)
+				start = time.time()
+				s.run()
+				return (s.results, time.time() - start)
+			
+			results,duration = timed_seek(max_results=1)
+			self.assertEquals(len(results), 1)
+			self.assertTrue(duration < 1)
+			
+			results,duration = timed_seek(max_results=2)
+			self.assertEquals(len(results), 2)
+			self.assertTrue(duration < 1)
+			
+			results,duration = timed_seek(idle_timeout=0.3)
+			self.assertTrue(set([self.svc2.sname, self.svc3.sname, self.svc4.sname]) <= set(svca.sname for svca in results))
+			self.assertTrue(duration < 1)
+			
+			if hasattr(minusconf, 'AsyncSeeker'):
+				import asyncio
+				loop = asyncio.new_event_loop()
+				try:
+					start = time.time()
+					results = loop.run_until_complete(minusconf.AsyncSeeker(self.svc2.stype, timeout=5, max_results=1, loop=loop).seek())
+					self.assertEquals(len(results), 1)
+					results = loop.run_until_complete(minusconf.AsyncSeeker(self.svc2.stype, timeout=5, idle_timeout=0.3, loop=loop).seek())
+					self.assertTrue(len(results) >= 3)
+					self.assertTrue(time.time() - start < 2)
+				finally:
+					loop.close()
+		finally:
+			a.stop_blocking()
+	
+	def testSeekerContext(self):
+		a = minusconf.ThreadAdvertiser([self.svc1, self.svc2, self.svc3], 'unittest.seekercontext.' + self._testid)
+		a.start_blocking()
+		
+		resolved = []
+		getaddrinfo = socket.getaddrinfo
+		def counting_getaddrinfo(*args, **kwargs):
+			resolved.append(args[0])
+			return getaddrinfo(*args, **kwargs)
+		socket.getaddrinfo = counting_getaddrinfo
+		
+		context = minusconf.SeekerContext()
+		try:
+			# In sequence
+			res = context.seek(self.svc2.stype, max_results=2)
+			self.assertEquals(set([self.svc2.sname, self.svc3.sname]), set(svca.sname for svca in res))
+			sock = context._sock
+			resolutions = len(resolved)
+			
+			res = context.seek(self.svc2.stype, timeout=0.5)
+			self.assertEquals(set([self.svc2.sname, self.svc3.sname]), set(svca.sname for svca in res))
+			self.assertTrue(context._sock is sock)
+			self.assertEquals(len(resolved), resolutions)
+			
+			# In parallel, on the same socket
+			s1 = minusconf.Seeker(self.svc1.stype, timeout=0.5, context=context)
+			s2 = minusconf.Seeker(self.svc2.stype, timeout=0.5, context=context)
+			s1.start()
+			s2.start()
+			s1.join()
+			s2.join()
+			self.assertEquals(set([self.svc1.sname]), set(svca.sname for svca in s1.results))
+			self.assertEquals(set([self.svc2.sname, self.svc3.sname]), set(svca.sname for svca in s2.results))
+			self.assertEquals(context._inboxes, [])
+		finally:
+			socket.getaddrinfo = getaddrinfo
+			context.close()
+			a.stop_blocking()
+		
+		self.assertRaises(minusconf.MinusconfError, context.seek, self.svc1.stype)
+	
+	def testSeekerPool(self):
+		a = minusconf.ThreadAdvertiser([self.svc1, self.svc2, self.svc3], 'unittest.seekerpool.' + self._testid)
+		a.start_blocking()
+		try:
+			snames = lambda results: set(svca.sname for svca in results)
+			
+			start = time.time()
+			res = minusconf.seek_many([self.svc1.stype, (self.svc2.stype,), (self.svc2.stype, '', self.svc3.sname), 'nonexistent-' + self._testid], timeout=0.5)
+			self.assertTrue(time.time() - start < 1)
+			self.assertEquals([snames(r) for r in res], [set([self.svc1.sname]), set([self.svc2.sname, self.svc3.sname]), set([self.svc3.sname]), set()])
+			
+			found = []
+			pool = minusconf.SeekerPool(timeout=5, max_results=1, find_callback=lambda query, svca: found.append((query.stype, svca.sname)))
+			q1 = pool.add(self.svc1.stype)
+			q2 = pool.add(self.svc2.stype, '', self.svc2.sname)
+			start = time.time()
+			pool.run()
+			self.assertTrue(time.time() - start < 1)
+			self.assertEquals(snames(q1.results), set([self.svc1.sname]))
+			self.assertEquals(snames(q2.results), set([self.svc2.sname]))
+			self.assertEquals(sorted(found), sorted([(self.svc1.stype, self.svc1.sname), (self.svc2.stype, self.svc2.sname)]))
+		finally:
+			a.stop_blocking()
+	
+	def testBulkTransfer(self):
+		stype = 'unittest-bulk-' + self._testid
+		services = [minusconf.Service(stype, str(1000 + i), 'instance ' + str(i)) for i in range(300)]
+		a = minusconf.ThreadAdvertiser(services, 'unittest.bulk.' + self._testid)
+		a.bulk_threshold = 50
+		a.metrics = minusconf.Metrics()
+		a.start_blocking()
+		try:
+			s = minusconf.Seeker(stype, timeout=5, max_results=len(services))
+			s.metrics = minusconf.Metrics()
+			s.run()
+			self.assertEquals(len(s.results), len(services))
+			self.assertEquals(s.metrics.snapshot()['counters'].get('bulk_transfers'), 1)
+			self.assertEquals(a.metrics.snapshot()['counters'].get('replies_sent'), None)
+			
+			# Seekers that do not accept bulk transfers get advertisements
+			s = minusconf.Seeker(stype, timeout=5, max_results=len(services))
+			s.accept_bulk = False
+			s.run()
+			self.assertEquals(len(s.results), len(services))
+			self.assertTrue(a.metrics.snapshot()['counters'].get('replies_sent') > 0)
+		finally:
+			a.stop_blocking()
+		
+		# If the bulk transfer fails, the query is repeated without accepting it
+		_cb = minusconf._compat_bytes
+		s = minusconf.Seeker(stype)
+		s._init_seeker()
+		s._sock.close()
+		s._sock = self._create_fake_sock()
+		s.addresses = ['127.0.0.1']
+		closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		closed.bind(('127.0.0.1', 0))
+		port = closed.getsockname()[1]
+		closed.close()
+		s._sock.family = socket.AF_INET
+		offer = minusconf._encode_string('x') + minusconf._encode_string('300') + minusconf._encode_string(str(port))
+		s._handle_packet(minusconf._MAGIC + minusconf._OPCODE_BULK_OFFER + offer, ('127.0.0.1', minusconf._PORT))
+		self.assertTrue(s._bulk_failed)
+		self.assertEquals(len(s._sock.sent), 1)
+		self.assertFalse(minusconf._OPCODE_BULK_OFFER in minusconf._decode_extensions(s._sock.sent[0][0], minusconf._HEADER_SIZE + 3 + len(stype))[minusconf._EXT_ACCEPTED_OPCODES])
+	
+	def testRetransmission(self):
+		class CountingSeeker(minusconf.Seeker):
+			def _send_query(self, addr):
+				self.sent_at.append(time.time() - self._start_time)
+				return minusconf.Seeker._send_query(self, addr)
+		
+		s = CountingSeeker('unittest.retransmission.' + self._testid, timeout=0.3, addresses=['127.0.0.1'])
+		s.retransmit_schedule = (0, 0.05, 0.1, 0.5)
+		s.sent_at = []
+		start = time.time()
+		s.run()
+		
+		self.assertEquals(len(s.sent_at), 3)
+		self.assertEquals(s.retransmits, 2)
+		self.assertEquals(s.retransmits_needed, 0)
+		self.assertTrue(s.sent_at[1] >= 0.05 and s.sent_at[2] >= 0.1)
+		self.assertTrue(time.time() - start < 0.5)
+		
+		a = minusconf.ThreadAdvertiser([self.svc1], 'unittest.retransmission.' + self._testid)
+		a.start_blocking()
+		try:
+			s = minusconf.Seeker(self.svc1.stype, timeout=1)
+			s.run()
+			self.assertTrue(self.svc1.sname in set(svca.sname for svca in s.results))
+			self.assertEquals(s.retransmits, 3)
+		finally:
+			a.stop_blocking()
+	
+	def testKnownAnswers(self):
+		_cb = minusconf._compat_bytes
+		a = minusconf.Advertiser([self.svc1, self.svc2, self.svc3], 'minusconf.test.knownanswers.' + self._testid)
+		a._sock = self._create_fake_sock()
+		
+		s = minusconf.Seeker(self.svc2.stype)
+		s._init_seeker()
+		s._sock.close()
+		s._sock = self._create_fake_sock()
+		
+		def query():
+			s._sock.sent = []
+			s._send_query(('::1', minusconf._PORT))
+			a._sock.sent = []
+			a._handle_packet(s._sock.sent[0][0], ('::1', 1234))
+			for packet,to in a._sock.sent:
+				s._handle_packet(packet, ('::1', 1234))
+			return len(a._sock.sent)
+		
+		self.assertEquals(query(), 1) # One aggregated advertisement
+		self.assertEquals(len(s.results), 2)
+		self.assertEquals(query(), 0)
+		
+		# Changed services are sent again
+		a.services.remove(self.svc3)
+		a.services.append(minusconf.Service(self.svc3.stype, self.svc3.port, self.svc3.sname, 'new location'))
+		self.assertEquals(query(), 1)
+		self.assertEquals(len(s.results), 3)
+		self.assertEquals(query(), 0)
+		
+		# Too many known answers: as many as fit are sent
+		s._digests = dict((i, _cb('%08d' % i)) for i in range(1000))
+		s._sock.sent = []
+		s._send_query(('::1', minusconf._PORT))
+		self.assertTrue(minusconf._MAX_PACKET_SIZE - minusconf._DIGEST_SIZE < len(s._sock.sent[0][0]) <= minusconf._MAX_PACKET_SIZE)
+		
+		# Unknown and malformed extensions are ignored
+		qry = minusconf._MAGIC + minusconf._OPCODE_QUERY + _cb('\0\0\0')
+		for ext in [_cb('\x63\x00\x01x'), _cb('\x01\x00\x09') + minusconf._digest(_cb('x')), _cb('\x01')]:
+			a._sock.sent = []
+			a._handle_packet(qry + ext, ('::1', 1234))
+			self.assertEquals(len(a._sock.sent), 3)
+	
+	def testAggregatedAdvertisements(self):
+		_cb = minusconf._compat_bytes
+		services = [minusconf.Service(self.svc2.stype, str(i), 'instance ' + str(i), 'host-' + str(i) + '.example.com') for i in range(100)]
+		a = minusconf.Advertiser(services, 'minusconf.test.aggregated.' + self._testid)
+		a._sock = self._create_fake_sock()
+		qry = minusconf._MAGIC + minusconf._OPCODE_QUERY + _cb('\0') + minusconf._encode_string(self.svc2.stype) + _cb('\0')
+		
+		# Old seekers get one advertisement per service
+		a._handle_packet(qry, ('::1', 1234))
+		self.assertEquals(len(a._sock.sent), 100)
+		self.assertTrue(all(packet[4:5] == minusconf._OPCODE_ADVERTISEMENT for packet,to in a._sock.sent))
+		
+		a._sock.sent = []
+		a._handle_packet(qry + minusconf._encode_extension(minusconf._EXT_ACCEPTED_OPCODES, minusconf._OPCODE_ADVERTISEMENTS), ('::1', 1234))
+		self.assertTrue(1 < len(a._sock.sent) < 10)
+		self.assertTrue(all(len(packet) <= minusconf._MAX_AGGREGATE_SIZE for packet,to in a._sock.sent))
+		
+		s = minusconf.Seeker(self.svc2.stype)
+		s._init_seeker()
+		s._sock.close()
+		for packet,to in a._sock.sent:
+			s._handle_packet(packet, ('::1', 1234))
+		self.assertEquals(set(svca.sname for svca in s.results), set(svc.sname for svc in services))
+		self.assertEquals(set(s._known_answers()), set(entry[2] for entry in a._get_catalog().lookup('', '')))
+		
+		# A truncated record is ignored, the ones before it are not
+		s._init_seeker()
+		s._sock.close()
+		s._handle_packet(a._sock.sent[0][0][:-3], ('::1', 1234))
+		self.assertTrue(len(s.results) > 0)
+		self.assertTrue(minusconf.ServiceAt(a.aname, services[0].stype, services[0].sname, services[0].location, services[0].port, '::1') in s.results)
+	
+	def testBrowser(self):
+		added = []
+		removed = []
+		b = minusconf.Browser(self.svc2.stype, interval=0.2, expiry=0.6,
+			added_callback=lambda b, svca: added.append(svca.sname), removed_callback=lambda b, svca: removed.append(svca.sname))
+		a = minusconf.ThreadAdvertiser([self.svc2, self.svc3], 'unittest.browser.' + self._testid)
+		a.start_blocking()
+		try:
+			b.start()
+			time.sleep(0.5)
+			self.assertEquals(set(added), set([self.svc2.sname, self.svc3.sname]))
+			
+			# Services still advertised are kept, even with known answers
+			time.sleep(1)
+			self.assertEquals(removed, [])
+			
+			a.services.remove(self.svc3)
+			time.sleep(1.2)
+			self.assertEquals(set(removed), set([self.svc3.sname]))
+			self.assertEquals(set(svca.sname for svca in b.results), set([self.svc2.sname]))
+			self.assertEquals(set(b.last_seen.keys()), b.results)
+		finally:
+			b.stop()
+			a.stop_blocking()
+		
+		# Bounded number of entries
+		b = minusconf.Browser(self.svc2.stype, max_entries=2, removed_callback=lambda b, svca: removed.append(svca.sname))
+		b._init_seeker()
+		b._sock.close()
+		removed = []
+		for sname in ['s1', 's2', 's1', 's3']:
+			b._found_result(minusconf.ServiceAt('a', self.svc2.stype, sname, '', '1', '::1'))
+		self.assertEquals(removed, ['s2'])
+		self.assertEquals(set(svca.sname for svca in b.results), set(['s1', 's3']))
+	
+	def testAnnouncements(self):
+		a = minusconf.Advertiser([self.svc2], 'minusconf.test.announcements.' + self._testid)
+		a._sock = self._create_fake_sock()
+		a._sock.family = socket.AF_INET
+		a.addresses = ['239.45.99.98']
+		a.announce_schedule = (0, 1, 4)
+		a._init_announcements()
+		
+		def opcodes():
+			res = [packet[4:5] for packet,to in a._sock.sent]
+			a._sock.sent = []
+			return res
+		
+		# Burst on start, at most every announce_interval
+		self.assertEquals(a._announce(), a.announce_interval)
+		self.assertEquals(opcodes(), [minusconf._OPCODE_ANNOUNCEMENT])
+		a.services.append(self.svc3)
+		self.assertTrue(0 < a._announce() <= a.announce_interval)
+		self.assertEquals(opcodes(), [])
+		a._last_announcement -= 1
+		a._announce()
+		self.assertEquals(opcodes(), [minusconf._OPCODE_ANNOUNCEMENT])
+		
+		# Removed services get a goodbye right away
+		a.services.remove(self.svc2)
+		a._announce()
+		sent = list(a._sock.sent)
+		self.assertEquals(opcodes(), [minusconf._OPCODE_GOODBYE])
+		self.assertTrue(sent[0][0].find(minusconf._encode_string(self.svc2.port)) >= 0)
+		self.assertTrue(sent[0][0].find(minusconf._encode_string(self.svc3.port)) < 0)
+		self.assertEquals(sent[0][1], ('239.45.99.98', minusconf._PORT))
+		
+		# Advertisers ignore announcements
+		a._handle_packet(sent[0][0], ('10.0.0.1', 1234))
+		self.assertEquals(opcodes(), [])
+		
+		# Seekers forget services from goodbyes, from any address
+		s = minusconf.Seeker(self.svc2.stype)
+		s._init_seeker()
+		s._sock.close()
+		catalog = minusconf._Catalog(a.aname, [self.svc2, self.svc3])
+		packet = catalog._aggregate(catalog.lookup('', ''), minusconf._OPCODE_ANNOUNCEMENT)[0]
+		s._handle_packet(packet, ('10.0.0.1', 1234))
+		s._handle_packet(packet, ('10.0.0.2', 1234))
+		self.assertEquals(len(s.results), 4)
+		s._handle_packet(sent[0][0], ('10.0.0.3', 1234))
+		self.assertEquals(set(svca.sname for svca in s.results), set([self.svc3.sname]))
+	
+	def testBrowserListening(self):
+		added = []
+		removed = []
+		b = minusconf.Browser(self.svc4.stype, interval=60,
+			added_callback=lambda b, svca: added.append(svca.sname), removed_callback=lambda b, svca: removed.append(svca.sname))
+		a = minusconf.ThreadAdvertiser([], 'unittest.browserlistening.' + self._testid)
+		a.start_blocking()
+		try:
+			b.start()
+			time.sleep(0.2)
+			a.services.append(self.svc4)
+			time.sleep(1)
+			self.assertTrue(self.svc4.sname in added)
+			
+			a.stop()
+			time.sleep(0.2)
+			self.assertTrue(self.svc4.sname in removed)
+			self.assertEquals(b.results, set())
+		finally:
+			b.stop()
+			a.stop_blocking()
+	
+	def testSharedCatalog(self):
+		if getattr(minusconf, 'shared_memory', None) == None:
+			return
+		import pickle
+		
+		a = minusconf.MultiprocessingAdvertiser([self.svc1, self.svc2], 'unittest.sharedcatalog.' + self._testid)
+		try:
+			reader = pickle.loads(pickle.dumps(a._shared_catalog))
+			self.assertFalse(reader.owner)
+			version,aname,services = reader.read()
+			self.assertEquals(aname, a.aname)
+			self.assertEquals(services, [self.svc1, self.svc2])
+			
+			a.services.append(self.svc3)
+			self.assertTrue(reader.version() > version)
+			version,aname,services = reader.read()
+			self.assertEquals(services, [self.svc1, self.svc2, self.svc3])
+			
+			a.services = [self.svc4]
+			a.aname = 'unittest.sharedcatalog.renamed.' + self._testid
+			self.assertEquals(reader.read()[1:], (a.aname, [self.svc4]))
+			
+			# What the advertiser process does
+			a._shared_catalog, parent = reader, a._shared_catalog
+			self.assertEquals(a.services_matching('', ''), [self.svc4])
+			catalog = a._get_catalog()
+			self.assertTrue(a._get_catalog() is catalog)
+			a._shared_catalog = parent
+			a.services.append(self.svc5)
+			a._shared_catalog = reader
+			self.assertEquals(a.services_matching('', ''), [self.svc4, self.svc5])
+			a._shared_catalog = parent
+			reader.close()
+		finally:
+			a._shared_catalog.close()
+	
+	def testShardedAdvertiser(self):
+		if not hasattr(minusconf, 'ShardedAdvertiser') or minusconf.shared_memory == None or not hasattr(socket, 'SO_REUSEPORT'):
+			return
+		import select
+		
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.bind(('', 0))
+		port = sock.getsockname()[1]
+		sock.close()
+		
+		a = minusconf.ShardedAdvertiser([self.svc1], 'unittest.sharded.' + self._testid, workers=3)
+		a.port = port
+		a.announce_schedule = ()
+		a.start_blocking()
+		try:
+			qry = minusconf._MAGIC + minusconf._OPCODE_QUERY + minusconf._encode_string('') + minusconf._encode_string(self.svc1.stype) + minusconf._encode_string('')
+			clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(40)]
+			try:
+				for i,c in enumerate(clients):
+					c.sendto(qry, ('127.0.0.1' if i % 2 else minusconf._ADDRESS_4, port))
+				
+				# Every query is answered exactly once
+				time.sleep(0.5)
+				for c in clients:
+					replies = 0
+					while select.select([c], [], [], 0)[0]:
+						c.recvfrom(minusconf._MAX_PACKET_SIZE)
+						replies += 1
+					self.assertEquals(replies, 1)
+			finally:
+				for c in clients:
+					c.close()
+			
+			self.assertEquals(sum(a.queries_per_worker()), 40)
+			self.assertTrue(len([n for n in a.queries_per_worker() if n > 0]) > 1)
+			
+			# Service updates reach the workers
+			a.services.append(self.svc2)
+			s = minusconf.Seeker(self.svc2.stype, port=port, timeout=0.5)
+			s.run()
+			self.assertTrue(self.svc2.sname in set(svca.sname for svca in s.results))
+		finally:
+			a.stop_blocking()
+	
+	def testLazyImports(self):
+		code = 'import sys, minusconf; sys.stdout.write(" ".join(m for m in ("multiprocessing", "asyncio", "ipaddr") if m in sys.modules))'
+		out = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(minusconf.__file__)))
+		self.assertEquals(out.strip(), ''.encode('ascii'))
+		
+		self.assertRaises(AttributeError, getattr, minusconf, 'NoSuchAdvertiser')
+	
 	def testInetPton(self):
 		bts = minusconf._compat_bytes
 		testVals = [
@@ -273,7 +989,7 @@ class MinusconfUnitTest(unittest.TestCase):
 		sksend(minusconf._MAGIC)
 		sksend(minusconf._MAGIC + _cb('\x00'))
 		sksend(minusconf._MAGIC + _cb('\xff'))
-
+		
 		# Advertiser-to-seeker opcode
 		sksend(minusconf._MAGIC + minusconf._OPCODE_QUERY + _cb('\0\0\0'))
 		
@@ -299,6 +1015,23 @@ class MinusconfUnitTest(unittest.TestCase):
 		
 		self.assertTrue(len(s.results) == 1)
 	
+	def testDecodeStrings(self):
+		_cb = minusconf._compat_bytes
+		sz = self._sharp_s
+		buf = _cb('xx') + minusconf._encode_string('a' + sz) + _cb('\0b\0c\0rest')
+		
+		self.assertEquals(minusconf._decode_strings(buf, 2, 1), (['a' + sz], 6))
+		self.assertEquals(minusconf._decode_strings(buf, 2, 4), (['a' + sz, '', 'b', 'c'], 11))
+		self.assertEquals(minusconf._decode_string(buf, 7), ('b', 9))
+		self.assertRaises(minusconf.MinusconfError, minusconf._decode_strings, buf, 2, 5)
+		self.assertRaises(minusconf.MinusconfError, minusconf._decode_strings, _cb(''), 0, 1)
+		self.assertRaises(minusconf.MinusconfError, minusconf._decode_strings, _cb('a\0\xff\0'), 0, 2)
+		self.assertEquals(minusconf._decode_strings(_cb('a\0\xff\0'), 0, 1), (['a'], 2))
+		
+		self.assertEquals(minusconf._parse_header(_cb('hello')), None)
+		self.assertEquals(minusconf._parse_header(minusconf._MAGIC), None)
+		self.assertEquals(minusconf._parse_header(minusconf._MAGIC + minusconf._OPCODE_QUERY), minusconf._OPCODE_QUERY)
+	
 	def _runSingleConcurrentAdvertiserTest(self, advertiser):
 		advertiser.start_blocking()
 		
@@ -379,8 +1112,11 @@ class MinusconfUnitTest(unittest.TestCase):
 	
 	def _create_fake_sock(self):
 		class _FakeSocket(object):
+			def __init__(sockself):
+				sockself.sent = []
+			
 			def sendto (sockself, data, flags, to):
-				pass
+				sockself.sent.append((data, to))
 		
 		return _FakeSocket()
 	